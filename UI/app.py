@@ -1,6 +1,9 @@
+import hashlib
 import json
 import re
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+import threading
+from collections import OrderedDict
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, session
 from functools import wraps
 import sys
 import os
@@ -8,7 +11,7 @@ import markdown
 
 # Add parent directory to Python path to import client
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from client import Client, sign_up
+from client import ClientPool, sign_up
 
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'  # Change this to a secure secret key
@@ -17,6 +20,15 @@ app.secret_key = 'your-secret-key-here'  # Change this to a secure secret key
 YCAP_HOST = "localhost"
 YCAP_PORT = 1200
 
+# logged-in YCAP sessions reused across requests instead of a new Client per route
+client_pool = ClientPool(max_size=64, idle_timeout=300)
+
+def pooled_client():
+    """Check out the pooled YCAP client of the logged-in user."""
+    client_data = session['client']
+    return client_pool.client(client_data['host'], client_data['port'],
+                              client_data['email'], client_data['password'])
+
 def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
@@ -38,7 +50,9 @@ def login():
         password = request.form['password']
         
         try:
-            client = Client(YCAP_HOST, YCAP_PORT, email, password)
+            # logging in through the pool leaves the verified session ready for the inbox
+            with client_pool.client(YCAP_HOST, YCAP_PORT, email, password):
+                pass
             session['user'] = email
             session['client'] = {
                 'host': YCAP_HOST,
@@ -76,9 +90,7 @@ def logout():
         client_data = session.get('client', {})
         if client_data:
             try:
-                client = Client(client_data['host'], client_data['port'], 
-                              client_data['email'], client_data['password'])
-                client.nrizz()
+                client_pool.close_account(client_data['host'], client_data['port'], client_data['email'])
             except:
                 pass
     session.clear()
@@ -88,30 +100,64 @@ def logout():
 @login_required
 def inbox():
     try:
-        client_data = session['client']
-        client = Client(client_data['host'], client_data['port'], 
-                       client_data['email'], client_data['password'])
-        
-        valid_emails = client.get_mail(sent=False, no=100)
+        with pooled_client() as client:
+            # headers only: bodies are fetched when a mail is opened
+            valid_emails, cursor = client.list_mail(sent=False, limit=100,
+                                                    before=request.args.get('before', type=int))
             
-        return render_template('inbox.html', emails=valid_emails)
+        return render_template('inbox.html', emails=valid_emails, cursor=cursor)
     except Exception as e:
         flash(f'Error fetching emails: {str(e)}', 'error')
         return redirect(url_for('login'))
 
+@app.route('/inbox/events')
+@login_required
+def inbox_events():
+    """Server-sent events stream of new inbox mail, pushed by the YCAP server instead of polled."""
+    client_data = session['client']
+
+    def stream():
+        # a dedicated connection: it sits in new_mail() for as long as the page stays open,
+        # resumed with the pooled session's ticket instead of a fresh password login
+        client = client_pool.dedicated(client_data['host'], client_data['port'], client_data['email'],
+                                       client_data['password'])
+        try:
+            client.subscribe()
+            while True:
+                # comment line: sends the headers at once and keeps proxies from cutting idle streams
+                yield ": keep-alive\n\n"
+                for header in client.new_mail(timeout=15):
+                    yield f"data: {json.dumps(header)}\n\n"
+                # a waiting subscriber sends nothing, so ping before the server's idle timeout reaps it
+                client.noop()
+        finally:
+            client.close()
+
+    return Response(stream(), mimetype='text/event-stream')
+
+@app.route('/search')
+@login_required
+def search():
+    query = request.args.get('q', '').strip()
+    results, cursor = [], None
+    if query:
+        try:
+            with pooled_client() as client:
+                results, cursor = client.search(query, limit=100, before=request.args.get('before', type=int))
+        except Exception as e:
+            flash(f'Error searching emails: {str(e)}', 'error')
+    return render_template('search.html', query=query, emails=results, cursor=cursor)
+
 @app.route('/sent')
 @login_required
 def sent():
     try:
-        client_data = session['client']
-        client = Client(client_data['host'], client_data['port'], 
-                       client_data['email'], client_data['password'])
-        
-        # Get mail IDs first
-        valid_emails = client.get_mail(sent=True)
+        with pooled_client() as client:
+            valid_emails, cursor = client.list_mail(sent=True, limit=100,
+                                                    before=request.args.get('before', type=int))
         
                 
-        return render_template('sent.html', emails=valid_emails)
+        return render_template('sent.html', emails=valid_emails, cursor=cursor)
     except Exception as e:
         flash(f'Error fetching sent emails: {str(e)}', 'error')
         return redirect(url_for('login'))
@@ -124,17 +170,25 @@ def compose():
         mail_type = request.form['type']
         mail_data = request.form['content']
         
-        if not to_addr.endswith('^ycap.com'):
-            to_addr += '^ycap.com'
+        # comma separated recipients go out as one bulk YAP
+        recipients = [addr.strip() for addr in to_addr.split(',') if addr.strip()]
+        recipients = [addr if addr.endswith('^ycap.com') else addr + '^ycap.com' for addr in recipients]
+        if len(recipients) == 1:
+            to_addr = recipients[0]
+        else:
+            to_addr = recipients
             
         try:
-            client_data = session['client']
-            client = Client(client_data['host'], client_data['port'], 
-                          client_data['email'], client_data['password'])
-            response = client.send_mail(to_addr, mail_type, mail_data)
+            with pooled_client() as client:
+                response = client.send_mail(to_addr, mail_type, mail_data)
             
             if response:
                 response_data = response.get('return', [])
+                if response_data[0] == 'MAIL_SENT' and isinstance(to_addr, list):
+                    flash(f'Email sent to {len(response_data[1])} of {len(to_addr)} recipients!', 'success')
+                    for addr, reason in response_data[2].items():
+                        flash(f'Not sent to {addr}: {reason}', 'error')
+                    return redirect(url_for('sent'))
                 if response_data[0] == 'MAIL_SENT':
                     mail_id = response_data[1]  # Get the mail ID from response
                     flash(f'Email sent successfully! Mail ID: {mail_id}', 'success')
@@ -148,42 +202,74 @@ def compose():
             flash(f'Error sending email: {str(e)}', 'error')
             
     return render_template('compose.html')
+# rendered mail bodies, newest use last: (mail id, body digest) -> html
+RENDER_CACHE_BYTES = 32 * 1024 * 1024
+render_cache = OrderedDict()
+render_cache_size = 0
+render_cache_lock = threading.Lock()
+# Markdown instances keep state between conversions, so each request thread reuses its own
+markdown_converters = threading.local()
+
+def markdown_converter():
+    converter = getattr(markdown_converters, 'converter', None)
+    if converter is None:
+        converter = markdown_converters.converter = markdown.Markdown(extensions=['nl2br'])
+    return converter
+
 def clean_email_text(text: str) -> str:
 
     
-    # Step 1: Replace literal \r\n with actual newlines
+    # Step 1: Remove escaped surrogate pairs
     text = re.sub(
         r'\\u[dD][89ABab][0-9A-Fa-f]{2}\\u[dD][CDEFcdef][0-9A-Fa-f]{2}',
         '',
         text
     )
     
-    # Step 2: Remove escaped surrogate pairs
+    # Step 2: Replace literal \r\n with actual newlines
     text = text.replace(r'\r\n', "\n")
     
     
     # Step 3: Convert Markdown to HTML with line breaks
-    html = markdown.markdown(text, extensions=['nl2br'])
+    converter = markdown_converter()
+    html = converter.convert(text)
+    converter.reset()
     
     return html
+
+def render_email(mail_id, text):
+    """clean_email_text through an LRU cache bounded by RENDER_CACHE_BYTES of html.
+
+    The key includes a digest of the body, so a different body under a reused id is never
+    served stale html.
+    """
+    global render_cache_size
+    key = (mail_id, hashlib.blake2b(text.encode('utf-8', 'replace'), digest_size=16).digest())
+    with render_cache_lock:
+        html = render_cache.get(key)
+        if html is not None:
+            render_cache.move_to_end(key)
+            return html
+    html = clean_email_text(text)
+    if len(html) > RENDER_CACHE_BYTES // 4:
+        return html
+    with render_cache_lock:
+        if key not in render_cache:
+            render_cache[key] = html
+            render_cache_size += len(html)
+            while render_cache_size > RENDER_CACHE_BYTES:
+                _, evicted = render_cache.popitem(last=False)
+                render_cache_size -= len(evicted)
+    return html
+
 @app.route('/view/<mail_id>')
 @login_required
 def view_email(mail_id):
     try:
-        client_data = session['client']
-        client = Client(client_data['host'], client_data['port'], 
-                       client_data['email'], client_data['password'])
-        email = client.GMA(mail_id)
-        if email[3] == "markdown":
-            email[4] = clean_email_text(email[4])
-            return render_template('view_email.html', email=email)
-        else:
-            email[4] = clean_email_text(email[4])
-            return render_template('view_email.html', email=email)
-
-            
-
-        flash('Email not found or invalid format.', 'error')
+        with pooled_client() as client:
+            email = client.GMA(mail_id)
+        email[4] = render_email(mail_id, email[4])
+        return render_template('view_email.html', email=email)
     except Exception as e:
         flash(f'Error viewing email: {str(e)}', 'error')
     
@@ -202,10 +288,8 @@ def delete_email(mail_id):
         source = 'sent'
     
     try:
-        client_data = session['client']
-        client = Client(client_data['host'], client_data['port'], 
-                       client_data['email'], client_data['password'])
-        response = client.NYAP(mail_id)
+        with pooled_client() as client:
+            response = client.NYAP(mail_id)
         response_data = response.get('return', [])
         print(response)
         
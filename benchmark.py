@@ -0,0 +1,306 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cryptography import fernet
+
+"""
+YCAP Benchmark Harness
+
+Starts a YCAP server engine in its own process, on an ephemeral port and a temporary database,
+and drives concurrent Clients through the scenarios below. Results (throughput and p50/p99
+latency per scenario, plus the server's own per-command metrics) are printed as JSON, so runs
+can be stored and diffed to catch regressions or to compare engines:
+
+    python benchmark.py --engine threaded async --clients 32 --output bench.json
+
+Scenarios:
+    login  every client logs in over a fresh connection again and again (login storm); each login
+           runs the password KDF, so compare --kdf-workers settings here
+    list   clients page through one large inbox with LYAP
+    yap    clients send mail to several recipients at once (bulk YAP)
+    gma    clients fetch large mail bodies with GMA
+"""
+
+SCENARIOS = ("login", "list", "yap", "gma")
+PASSWORD = "benchmark"
+WORDS = ("ycap", "mail", "inbox", "rizz", "yap", "server", "client", "frame", "packet", "latency", "body",
+         "subject", "hello", "meeting", "report", "quarterly", "update", "please", "review", "thanks")
+
+
+def account(n):
+    return f"bench{n}^ycap.com"
+
+
+def mail_body(rng, size):
+    """Text of about ``size`` bytes that compresses like real mail rather than like random bytes."""
+    words = []
+    length = -1
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        # every word after the first brings a separating space
+        length += len(word) + 1
+    return " ".join(words)[:size]
+
+
+def percentile(ordered, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))]
+
+
+def summarize(latencies, errors, seconds):
+    ordered = sorted(latencies)
+    return {
+        "ops": len(ordered),
+        "errors": errors,
+        "seconds": round(seconds, 4),
+        "throughput": round(len(ordered) / seconds, 2) if seconds else 0.0,
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 3),
+        "max_ms": round(ordered[-1] * 1000, 3) if ordered else 0.0,
+    }
+
+
+def seed_database(db_path, config):
+    """Create the benchmark accounts, the large inbox and the big mails before the server starts."""
+    from server import STORE_COMPRESSION, open_store
+    from ycap_passwords import hash_password
+    from ycap_protocol import compress_body
+
+    rng = random.Random(config["seed"])
+    store = open_store(db_path, config["shards"])
+    # one hash for every account: seeding should not spend a KDF run per account
+    password_hash = hash_password(PASSWORD)
+    for n in range(config["accounts"]):
+        store.create_user(account(n), password_hash)
+    inbox = [(account(n % config["accounts"]), account(0), mail_body(rng, config["body_size"]))
+             for n in range(config["mailbox"])]
+    big = [(account(1), account(1), mail_body(rng, config["big_body_size"])) for _ in range(config["big_mails"])]
+
+    def insert(mail):
+        data, encoding = compress_body(mail[2], STORE_COMPRESSION)
+        return store.insert_mail(mail[0], mail[1], "text", data, encoding)
+
+    # concurrent inserts share group commits, so seeding a big mailbox takes seconds, not minutes
+    with ThreadPoolExecutor(max_workers=64) as pool:
+        list(pool.map(insert, inbox))
+        big_ids = list(pool.map(insert, big))
+    store.close()
+    return big_ids
+
+
+def serve_engine(engine, db_path, key_file, kdf_workers, shards, control):
+    """Server process: run one engine and answer ``stats``/``stop`` requests from the harness."""
+    # the servers log every connection; keep that out of the measurements
+    sys.stdout = open(os.devnull, "w")
+    from server import AsyncServer, Server
+
+    engine_class = AsyncServer if engine == "async" else Server
+    server = engine_class("127.0.0.1", 0, key_file=key_file, db_path=db_path, kdf_workers=kdf_workers,
+                          shards=shards)
+    threading.Thread(target=server.ycap_run, daemon=True).start()
+    server.ready.wait()
+    control.send(server.port)
+    while True:
+        request = control.recv()
+        if request == "stats":
+            control.send(server.metrics.snapshot())
+        else:
+            return
+
+
+class Scenario:
+    """One timed scenario: ``clients`` threads each run ``ops`` operations after a common start."""
+
+    def __init__(self, name, port, config, big_ids):
+        self.name = name
+        self.port = port
+        self.config = config
+        self.big_ids = big_ids
+
+    def connect(self, n):
+        from client import Client
+
+        return Client("127.0.0.1", self.port, account(n), PASSWORD, key_file=self.config["key_file"])
+
+    def run(self):
+        clients = self.config["clients"]
+        start = threading.Barrier(clients + 1)
+        results = [None] * clients
+
+        def worker(index):
+            rng = random.Random(self.config["seed"] * 1000 + index)
+            try:
+                operation, close = self.prepare(index, rng)
+            except Exception:
+                start.wait()
+                results[index] = ([], self.config["ops"])
+                return
+            start.wait()
+            latencies = []
+            errors = 0
+            for _ in range(self.config["ops"]):
+                began = time.perf_counter()
+                try:
+                    ok = operation()
+                except Exception:
+                    ok = False
+                if ok:
+                    latencies.append(time.perf_counter() - began)
+                else:
+                    errors += 1
+            close()
+            results[index] = (latencies, errors)
+
+        threads = [threading.Thread(target=worker, args=(index,)) for index in range(clients)]
+        for thread in threads:
+            thread.start()
+        start.wait()
+        began = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        seconds = time.perf_counter() - began
+        latencies = [latency for result in results for latency in result[0]]
+        return summarize(latencies, sum(result[1] for result in results), seconds)
+
+    def prepare(self, index, rng):
+        """Set up one client thread.
+
+        Returns:
+            tuple: (operation returning True on success, cleanup callable)
+        """
+        accounts = self.config["accounts"]
+        if self.name == "login":
+            def login():
+                client = self.connect(index % accounts)
+                client.close()
+                return True
+
+            return login, lambda: None
+        if self.name == "list":
+            client = self.connect(0)
+            cursor = [None]
+
+            def list_page():
+                page = client.list_mail(limit=self.config["page_size"], before=cursor[0])
+                if page is None:
+                    return False
+                # walk the inbox page by page, starting over at the end
+                cursor[0] = page[1]
+                return True
+
+            return list_page, client.close
+        if self.name == "yap":
+            client = self.connect(index % accounts)
+            body = mail_body(rng, self.config["body_size"])
+
+            def bulk_send():
+                recipients = [account(rng.randrange(accounts)) for _ in range(self.config["recipients"])]
+                answer = client.send_mail(recipients, "text", body)
+                return answer is not None and answer.get("return")[0] == "MAIL_SENT"
+
+            return bulk_send, client.close
+        client = self.connect(1)
+
+        def fetch_big():
+            mail = client.GMA(rng.choice(self.big_ids))
+            return mail is not None and len(mail[4]) == self.config["big_body_size"]
+
+        return fetch_big, client.close
+
+
+def run_engine(engine, config):
+    """Benchmark one engine on a fresh database and return its results."""
+    with tempfile.TemporaryDirectory(prefix="ycap-bench-") as workdir:
+        db_path = os.path.join(workdir, "bench.db")
+        big_ids = seed_database(db_path, config)
+        context = multiprocessing.get_context("spawn")
+        control, child_control = context.Pipe()
+        # not a daemon: the server starts its own password hashing processes
+        process = context.Process(target=serve_engine,
+                                  args=(engine, db_path, config["key_file"], config["kdf_workers"], config["shards"],
+                                        child_control))
+        process.start()
+        try:
+            if not control.poll(30):
+                raise RuntimeError(f"{engine} server did not start")
+            port = control.recv()
+            scenarios = {}
+            for name in config["scenarios"]:
+                scenarios[name] = Scenario(name, port, config, big_ids).run()
+                print(f"{engine:>8} {name:>5}: {scenarios[name]['throughput']:>10} ops/s  "
+                      f"p50 {scenarios[name]['p50_ms']} ms  p99 {scenarios[name]['p99_ms']} ms",
+                      file=sys.stderr)
+            control.send("stats")
+            server_metrics = control.recv()
+            control.send("stop")
+        finally:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+    commands = {command: {key: stats[key] for key in ("count", "errors", "p50", "p99")}
+                for command, stats in server_metrics["commands"].items()}
+    return {"scenarios": scenarios, "server_commands": commands, "server_timings": server_metrics["timings"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark YCAP server engines")
+    parser.add_argument("--engine", nargs="+", choices=["threaded", "async"], default=["threaded"],
+                        help="engines to benchmark, each on its own server process and database")
+    parser.add_argument("--scenario", nargs="+", choices=SCENARIOS, default=list(SCENARIOS), dest="scenarios")
+    parser.add_argument("--clients", type=int, default=16, help="concurrent clients per scenario")
+    parser.add_argument("--ops", type=int, default=200, help="operations per client per scenario")
+    parser.add_argument("--accounts", type=int, default=50, help="accounts created for the run")
+    parser.add_argument("--mailbox", type=int, default=10000, help="mails in the inbox the list scenario pages")
+    parser.add_argument("--page-size", type=int, default=50, help="LYAP page size of the list scenario")
+    parser.add_argument("--recipients", type=int, default=10, help="recipients per bulk YAP")
+    parser.add_argument("--body-size", type=int, default=2048, help="bytes per ordinary mail body")
+    parser.add_argument("--big-mails", type=int, default=20, help="large mails the gma scenario fetches")
+    parser.add_argument("--big-body-size", type=int, default=1024 * 1024, help="bytes per large mail body")
+    parser.add_argument("--kdf-workers", type=int, default=2,
+                        help="server processes checking passwords; the login scenario is bound by them")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="SQLite files the mail is spread over; compare yap throughput across counts")
+    parser.add_argument("--seed", type=int, default=1, help="seed for bodies and recipient choice")
+    parser.add_argument("--output", default=None, help="write the JSON results here instead of stdout")
+    args = parser.parse_args(argv)
+    if args.accounts < 2:
+        parser.error("--accounts must be at least 2")
+
+    config = {key: value for key, value in vars(args).items() if key not in ("engine", "output")}
+    with tempfile.NamedTemporaryFile("wb", suffix=".key", delete=False) as key_file:
+        # a throwaway YCAP master key shared by the server process and the clients
+        key_file.write(fernet.Fernet.generate_key())
+    config["key_file"] = key_file.name
+    try:
+        results = {engine: run_engine(engine, config) for engine in args.engine}
+    finally:
+        os.unlink(key_file.name)
+    del config["key_file"]
+    report = {
+        "config": config,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
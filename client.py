@@ -1,8 +1,16 @@
+import asyncio
 import socket
 import json      
+from collections import deque
+import threading
+import time
+from contextlib import contextmanager
 from cryptography import fernet      
-import os
 import warnings                   
+from ycap_protocol import (COMPRESSIONS, JSON_CODEC, PUSH_COMMAND, STREAM_CHUNK_SIZE, AsyncFramedChannel,
+                           FramedChannel, RawChannel, body_from_wire, body_to_wire, choose_codec, compress_body,
+                           decompress_body, load_ycap_key)
+from ycap_metrics import Metrics
 
 """
 YCAP Protocol Client Implementation
@@ -11,26 +19,38 @@ This module provides a client implementation for the YCAP email protocol.
 Handles connection to YCAP servers and implements protocol commands for sending and receiving emails.
 """
 
-def sign_up(user_id, password, host, port):
+def open_channel(sock, framed=True):
+    """Wrap a connected socket in the channel for the chosen wire mode."""
+    # packets are written whole, so Nagle's algorithm would only delay them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if framed:
+        return FramedChannel(sock)
+    return RawChannel(sock, bufsize=105000)
+
+def ycap_fernet(key_file=None):
+    """Fernet cipher for the shared YCAP master key, loaded once per process."""
+    return fernet.Fernet(load_ycap_key(key_file))
+
+def sign_up(user_id, password, host, port, framed=True, key_file=None):
         s = socket.socket()
         address = (host, port)
         try:
             s.connect(address)
         except:
             ConnectionError("YCAP Server not active or blocked by firewall")
+        channel = open_channel(s, framed)
         
-        s.send(user_id.encode())
-        defaut_YCAP_key = os.popen("echo %YCAP_KEY%").read()
-        fernet_YCAP = fernet.Fernet(defaut_YCAP_key)
-        super_secret_key = fernet_YCAP.decrypt(s.recv(1024))
+        channel.send(user_id.encode())
+        fernet_YCAP = ycap_fernet(key_file)
+        super_secret_key = fernet_YCAP.decrypt(channel.recv())
         fernet_for_agkey = fernet.Fernet(super_secret_key)
-        s.send(json.dumps({"credentials":(fernet_for_agkey.encrypt(password.encode()).decode())}).encode())
-        response_packet = json.loads(s.recv(1024).decode())
+        channel.send(json.dumps({"credentials":(fernet_for_agkey.encrypt(password.encode()).decode())}).encode())
+        response_packet = json.loads(channel.recv().decode())
         if response_packet == ["USER SECURELY VERIFIED"]:
             return True
         else:
-            s.send(json.dumps(["SIGN UP"]).encode())
-            s.send(json.dumps([fernet_for_agkey.encrypt(user_id.encode()).decode(), fernet_for_agkey.encrypt(password.encode()).decode()]).encode())
+            channel.send(json.dumps(["SIGN UP"]).encode())
+            channel.send(json.dumps([fernet_for_agkey.encrypt(user_id.encode()).decode(), fernet_for_agkey.encrypt(password.encode()).decode()]).encode())
             return True
             
         
@@ -40,14 +60,38 @@ class Client:
     
     Provides methods to connect to a YCAP server and send/receive emails using the YCAP protocol.
     Implements all standard YCAP commands including YCAP (handshake), YAP (send), LYAP (list), etc.
+    Speaks framed YCAP by default; pass ``framed=False`` to talk to a legacy unframed server.
+    Packets use the first of ``codecs`` the server agrees to in the handshake (binary by
+    default), and plain JSON with servers that do not negotiate codecs. Likewise, bodies of
+    COMPRESSION_THRESHOLD bytes or more are sent packed with the first of ``compression`` the
+    server agrees to, and bodies read back are unpacked transparently.
+
+    A framed login also yields a resumption ticket in ``client.ticket``. Passing it back as
+    ``ticket=`` on reconnect skips the key exchange and the password check; if the server
+    refuses it (expired, revoked, server restarted) the client logs in with ``password``.
+
+    ``client.metrics`` records the latency of every command, from the moment its request starts
+    sending until its response arrives, and the bytes moved. Pass one Metrics as ``metrics=`` to several
+    clients to add them up.
     """
 
 
        
-    def __init__(self, host, port, mailaddress, password,):
+    def __init__(self, host, port, mailaddress, password, framed=True, key_file=None, codecs=("binary", "json"),
+                 compression=("zlib", "lzma"), ticket=None, metrics=None):
         self.host = host
         self.port = port
+        self.metrics = metrics if metrics is not None else Metrics()
         self.emailaddress = mailaddress
+        self.codecs = list(codecs)
+        self.codec = JSON_CODEC
+        self.compressions = list(compression)
+        self.compression = None
+        # headers of NEW_MAIL pushes not yet handed out by new_mail()
+        self.pending_mail = deque()
+        self.on_new_mail = None
+        # when the command in flight began sending (see _send)
+        self.sent_at = time.perf_counter()
 
         
         self.s = socket.socket()
@@ -56,34 +100,97 @@ class Client:
             self.s.connect(self.address)
         except:
             ConnectionError("YCAP Server not active or blocked by firewall")
+        self.channel = open_channel(self.s, framed)
+        self.channel.metrics = self.metrics
+        self.ticket = None
+        if ticket is not None and framed and self.resume(ticket):
+            return
     
 
-        self.s.send(self.emailaddress.encode())
-        self.defaut_YCAP_key = os.popen("echo %YCAP_KEY%").read(1024)
-        self.fernet_YCAP = fernet.Fernet(self.defaut_YCAP_key)
-        self.super_secret_key = self.fernet_YCAP.decrypt(self.s.recv(1024))
+        self.channel.send(self.emailaddress.encode())
+        self.fernet_YCAP = ycap_fernet(key_file)
+        self.super_secret_key = self.fernet_YCAP.decrypt(self.channel.recv())
         self.fernet_for_agkey = fernet.Fernet(self.super_secret_key)
         self.login(password)
-        response_packet = json.loads(self.s.recv(1024).decode())    
-        if response_packet == ["USER SECURELY VERIFIED"]:
-            pass
+        response_packet = json.loads(self.channel.recv().decode())    
+        if response_packet[0] == "USER SECURELY VERIFIED":
+            options = response_packet[1] if len(response_packet) > 1 else {}
+            self.codec = choose_codec([options.get("codec")])
+            self.compression = options.get("compression")
+            self.ticket = options.get("ticket")
         else:
-            self.s.send(json.dumps(["QUIT"]).encode())
+            self.channel.send(json.dumps(["QUIT"]).encode())
             raise NotImplementedError("USER NOT IN SERVER DB")
-        self.key = str(self.s.recv(64).decode())
+        self.key = str(self.channel.recv().decode())
 
     def login(self, password):
         password = (self.fernet_for_agkey.encrypt(password.encode()).decode())
-        self.s.send(json.dumps({"credentials":password}).encode())
+        self.channel.send(json.dumps({"credentials":password, "codecs":self.codecs,
+                                      "compression":self.compressions, "tickets":True}).encode())
+
+    def resume(self, ticket):
+        """Open the session from a resumption ticket.
+
+        Returns:
+            bool: True if the server resumed the session; on False the connection is ready for a full login
+        """
+        self.channel.send(json.dumps({"resume":ticket, "codecs":self.codecs,
+                                      "compression":self.compressions}).encode())
+        response_packet = json.loads(self.channel.recv().decode())
+        if response_packet[0] != "SESSION RESUMED":
+            return False
+        options = response_packet[1]
+        self.codec = choose_codec([options.get("codec")])
+        self.compression = options.get("compression")
+        self.ticket = ticket
+        self.key = str(self.channel.recv().decode())
+        return True
+
+    def revoke_tickets(self):
+        """Revoke every resumption ticket of this account using the REVOKE command."""
+        packet = {
+            "connection_key": self.key,
+            "command": "REVOKE",
+            "arguments": []
+        }
+        self._send(self.codec.encode(packet))
+        answer_packet = self._recv_packet()
+        return answer_packet.get("return")[0] == "TICKETS_REVOKED"
+
+    def _send(self, payload):
+        """Send one encoded command packet; its round-trip in the metrics is timed from here."""
+        self.sent_at = time.perf_counter()
+        self.channel.send(payload)
+
+    def _recv_packet(self):
+        """Read the response to the command in flight, setting aside pushes that arrive first.
+
+        The command's latency is recorded from the moment _send began sending it, so the
+        time spent sending (and streaming an SYAP body) is included.
+        """
+        started = self.sent_at
+        packet = self.codec.decode(self.channel.recv())
+        while packet.get("command") == PUSH_COMMAND:
+            self._deliver(packet.get("return"))
+            packet = self.codec.decode(self.channel.recv())
+        self.metrics.observe_command(packet.get("command") or "UNKNOWN", time.perf_counter() - started)
+        return packet
+
+    def _deliver(self, header):
+        if self.on_new_mail is not None:
+            self.on_new_mail(header)
+        else:
+            self.pending_mail.append(header)
+
     def ycap(self,):
         packet = {
                     "connection_key":self.key,
                     "command":"YCAP",
                     "arguments":[[self.host, self.port]]
              }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
-        answer_packet = json.loads(self.s.recv(1024).decode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
+        answer_packet = self._recv_packet()
         if answer_packet.get("return")[0] == "YES":
             return True
         return False
@@ -94,10 +201,10 @@ class Client:
                     "command":"NRIZZ",
                     "arguments":["GOODBYE"]
              }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
 
-        answer_packet = json.loads(self.s.recv(1024).decode())
+        answer_packet = self._recv_packet()
         if answer_packet.get("return")[0] == "GOODBYE":
             self.s.close()
             return True
@@ -110,39 +217,56 @@ class Client:
                     "command":"NOOP",
                     "arguments":["NOOP"]
              }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
         
-        answer_packet = json.loads(self.s.recv(1024).decode())
+        answer_packet = self._recv_packet()
         if answer_packet.get("return")[0] == "NOOP":
             return True
         
         return False
 
+    def close(self):
+        """Drop the connection without logging out (the server reaps the session)."""
+        try:
+            self.s.close()
+        except Exception:
+            pass
+
     def send_mail(self,  to_addr, mail_type, mail_data):
         """Send an email using the YAP command.
         
         Args:
-            to_addr (str): Recipient's email address
+            to_addr (str | list): Recipient's email address, or a list of them for a bulk send
+                in one round-trip and one server-side transaction
             mail_type (str): Type of mail (e.g., 'text', 'html')
             mail_data (str): Email content
             
         Returns:
-            dict: Server response containing status and new mail ID
+            dict: Server response containing status and new mail ID; for a bulk send the return is
+                ``["MAIL_SENT", {to: mail_id}, {to: reason}]``
             None: If sending fails
         """
+        if not isinstance(to_addr, str):
+            to_addr = list(to_addr)
+        arguments = [[self.emailaddress, to_addr], mail_type, mail_data]
+        body, encoding = compress_body(mail_data, self.compression)
+        if encoding is not None:
+            arguments[2:] = [body_to_wire(body, self.codec), encoding]
         packet = {
             "connection_key": self.key,
             "command": "YAP",
-            "arguments": [[self.emailaddress, to_addr], mail_type, mail_data]
+            "arguments": arguments
         }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
         # Optionally, wait for a response (if server sends one)
         try:
-            answer_packet = json.loads(self.s.recv(1024).decode())
+            answer_packet = self._recv_packet()
             if answer_packet.get("return")[0] == "MAIL_NOT_SENT":
-                warnings.warn(f"Due to '{answer_packet.get("return")[1]}' mail is not sent")
+                warnings.warn(f"Due to '{answer_packet.get('return')[1]}' mail is not sent")
+            elif isinstance(to_addr, list) and answer_packet.get("return")[2]:
+                warnings.warn(f"Mail is not sent to {', '.join(answer_packet.get('return')[2])}")
             return answer_packet
         except Exception as e:
             print("No response or error:", e) 
@@ -152,69 +276,634 @@ class Client:
             "command": "GMA",
             "arguments": [id]
         }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
+        try:
+            answer_packet = self._recv_packet()
+            return self._open_mail(answer_packet.get("return")[0])
+        except Exception as e:
+            print("No response or error:", e)
+            return None
+    def MGMA(self, ids):
+        """Fetch several mails in one round-trip using the MGMA command.
+
+        Args:
+            ids (list): Mail ids to fetch
+
+        Returns:
+            list: Mail rows ``[id, from, to, type, data]`` in the order of ``ids``
+            None: If the request fails
+        """
+        packet = {
+            "connection_key": self.key,
+            "command": "MGMA",
+            "arguments": [list(ids)]
+        }
+        packet = self.codec.encode(packet)
+        self._send(packet)
         try:
-            answer_packet = json.loads(self.s.recv(105000).decode())
-            return answer_packet.get("return")[0]
+            answer_packet = self._recv_packet()
+            return [self._open_mail(row) for row in answer_packet.get("return")]
         except Exception as e:
             print("No response or error:", e)
             return None
+
+    @staticmethod
+    def _open_mail(row):
+        """Unpack a compressed body and drop the encoding field, giving ``[id, from, to, type, data]``."""
+        if len(row) > 5:
+            encoding = row.pop(5)
+            row[4] = decompress_body(body_from_wire(row[4]), encoding) if encoding else row[4]
+        return row
+
+    def SGMA(self, id):
+        """Stream a mail body from the server in chunks using the SGMA command.
+
+        The body is never held in memory as a whole. The chunk generator must be consumed or
+        closed before the next command is sent on this client; closing it early drains the
+        rest of the stream.
+        
+        Args:
+            id (str): Mail id
+            
+        Returns:
+            tuple: (header ``[id, from, to, type, size]``, generator of ``bytes`` chunks); ``size`` is
+            the byte count on the wire, which for a compressed body is its packed size
+            None: If the mail does not exist
+        """
+        if not self.channel.framed:
+            raise NotImplementedError("Streaming needs framed YCAP")
+        packet = {
+            "connection_key": self.key,
+            "command": "SGMA",
+            "arguments": [id]
+        }
+        packet = self.codec.encode(packet)
+        self._send(packet)
+        answer_packet = self._recv_packet()
+        header = answer_packet.get("return")
+        if not header:
+            return None
+        encoding = header.pop(5) if len(header) > 5 else None
+        return header, self._body_chunks(encoding)
+
+    def _body_chunks(self, encoding=None):
+        finished = False
+        decompressor = COMPRESSIONS[encoding].decompressor() if encoding else None
+        try:
+            chunk = self.channel.recv()
+            while chunk:
+                yield decompressor.decompress(chunk) if decompressor else chunk
+                chunk = self.channel.recv()
+            finished = True
+        finally:
+            # keep the connection in sync if the caller stopped reading early
+            while not finished:
+                chunk = self.channel.recv()
+                finished = not chunk
+
+    def send_mail_stream(self, to_addr, mail_type, body, size):
+        """Send a large email by streaming its body with the SYAP command.
+        
+        Args:
+            to_addr (str): Recipient's email address
+            mail_type (str): Type of mail (e.g., 'text', 'html')
+            body: Binary file object, or an iterable of ``bytes`` chunks
+            size (int): Total body size in bytes; the server rejects the mail if it differs
+            
+        Returns:
+            dict: Server response, ``["MAIL_SENT", mail_id]`` or ``["MAIL_NOT_SENT", reason]``
+        """
+        if not self.channel.framed:
+            raise NotImplementedError("Streaming needs framed YCAP")
+        packet = {
+            "connection_key": self.key,
+            "command": "SYAP",
+            "arguments": [[self.emailaddress, to_addr], mail_type, size]
+        }
+        packet = self.codec.encode(packet)
+        self._send(packet)
+        chunks = body
+        if hasattr(body, "read"):
+            chunks = iter(lambda: body.read(STREAM_CHUNK_SIZE), b"")
+        for chunk in chunks:
+            for start in range(0, len(chunk), STREAM_CHUNK_SIZE):
+                self.channel.send(chunk[start:start + STREAM_CHUNK_SIZE])
+        self.channel.send(b"")
+        answer_packet = self._recv_packet()
+        if answer_packet.get("return")[0] == "MAIL_NOT_SENT":
+            warnings.warn(f"Due to '{answer_packet.get('return')[1]}' mail is not sent")
+        return answer_packet
+
     def NYAP(self, id):
         packet = {
             "connection_key": self.key,
             "command": "NYAP",
             "arguments": [id]
         }
-        packet = json.dumps(packet)
-        self.s.send(packet.encode())
+        packet = self.codec.encode(packet)
+        self._send(packet)
         try:
-            answer_packet = json.loads(self.s.recv(1024).decode())
+            answer_packet = self._recv_packet()
             if answer_packet.get("return")[0] == "MAIL_NOT_DELETED":
-                warnings.warn(f"Due to '{answer_packet.get("return")[1]}' mail is not deleted")
+                warnings.warn(f"Due to '{answer_packet.get('return')[1]}' mail is not deleted")
             return answer_packet
         except Exception as e:
             print("No response or error:", e)
             return None
-    def get_mail(self, sent=False, no=10):
-        """Request mail from server using the LYAP command.
+    def subscribe(self, callback=None):
+        """Ask the server to push new mail for this account using the SUB command.
+
+        Pushed ``[id, from, to, type]`` headers are handed to ``callback`` if one is given,
+        otherwise they queue up for new_mail(). Pushes are read whenever this client reads
+        from the server: while waiting for any command's response, or inside new_mail().
+        
+        Args:
+            callback (callable, optional): Called with each pushed header
+            
+        Returns:
+            bool: True if the server accepted the subscription (it needs framed YCAP)
+        """
+        self.on_new_mail = callback
+        packet = {
+            "connection_key": self.key,
+            "command": "SUB",
+            "arguments": []
+        }
+        self._send(self.codec.encode(packet))
+        answer_packet = self._recv_packet()
+        return answer_packet.get("return")[0] == "SUBSCRIBED"
+
+    def unsubscribe(self):
+        """Stop new mail pushes using the UNSUB command."""
+        packet = {
+            "connection_key": self.key,
+            "command": "UNSUB",
+            "arguments": []
+        }
+        self._send(self.codec.encode(packet))
+        answer_packet = self._recv_packet()
+        return answer_packet.get("return")[0] == "UNSUBSCRIBED"
+
+    def new_mail(self, timeout=None):
+        """Iterate over pushed new mail after subscribe().
+
+        Yields headers already queued, then blocks for further pushes. With a subscribe()
+        callback set, pushes go to the callback and iterating only keeps reading them. Do not
+        send other commands on this client from another thread while iterating.
         
-        Retrieves emails matching the specified filters. All filter parameters are optional.
+        Args:
+            timeout (float, optional): Stop after this many seconds without a push; None waits forever
+            
+        Yields:
+            list: ``[id, from, to, type]`` header of each new mail
+        """
+        while True:
+            while self.pending_mail:
+                yield self.pending_mail.popleft()
+            self.s.settimeout(timeout)
+            try:
+                data = self.channel.recv()
+            except socket.timeout:
+                return
+            finally:
+                self.s.settimeout(None)
+            if data is None:
+                return
+            packet = self.codec.decode(data)
+            if packet.get("command") == PUSH_COMMAND:
+                self._deliver(packet.get("return"))
+
+    def list_mail(self, sent=False, limit=50, before=None, headers=True):
+        """List one page of the inbox or sent box, newest first, using LYAP.
         
         Args:
-            from_addr (str, optional): Filter by sender address
-            to_addr (str, optional): Filter by recipient address
-            mail_type (str, optional): Filter by mail type
-            mail_data (str, optional): Filter by content
-            since_id (int, optional): Only fetch messages with ID > since_id
+            sent (bool, optional): List the sent box instead of the inbox
+            limit (int, optional): Page size
+            before (int, optional): Cursor returned with the previous page
+            headers (bool, optional): Return ``[id, from, to, type]`` rows instead of bare ids
             
         Returns:
-            dict: Server response containing matching emails
+            tuple: (ids or header rows, cursor for the next page or None on the last page)
             None: If request fails
         """
-
         packet = {
             "connection_key": self.key,
             "command": "LYAP",
-            "arguments": [ sent ]
+            "arguments": [sent, limit, before, headers]
         }
-        packet = json.dumps(packet)
+        packet = self.codec.encode(packet)
         try:
-            self.s.send(packet.encode())
+            self._send(packet)
         except Exception as e:
             print("Failed to send LYAP request:", e)
             return None
         try:
-            answer_packet = json.loads(self.s.recv(8192).decode())
-            mails = []
-            if len(answer_packet.get("return")) > no:
-                for i in range(no):
-                    mails.append(self.GMA(answer_packet.get("return")[i]))
-            else:
-                for i in answer_packet.get("return"):
-                    mails.append(self.GMA(i))   
-            return mails
+            answer_packet = self._recv_packet()
+            return answer_packet.get("return"), answer_packet.get("cursor")
         except Exception as e:
             print("No response or error:", e)
             return None
 
+    def search(self, query, limit=50, before=None):
+        """Search the sent and received mail of this account using the SEARCH command.
+
+        Args:
+            query (str): Words that must all appear in the sender, recipient or body; end a
+                word with ``*`` to match it as a prefix
+            limit (int, optional): Page size
+            before (int, optional): Cursor returned with the previous page
+
+        Returns:
+            tuple: (``[id, from, to, type]`` rows newest first, cursor for the next page or None)
+            None: If request fails
+        """
+        packet = {
+            "connection_key": self.key,
+            "command": "SEARCH",
+            "arguments": [query, limit, before]
+        }
+        self._send(self.codec.encode(packet))
+        try:
+            answer_packet = self._recv_packet()
+            return answer_packet.get("return"), answer_packet.get("cursor")
+        except Exception as e:
+            print("No response or error:", e)
+            return None
+
+    def get_mail(self, sent=False, no=10, before=None):
+        """Request mail from server using the LYAP and MGMA commands.
+        
+        Lists one page of ``no`` mail ids with LYAP, newest first, then fetches them in one MGMA batch.
+        
+        Args:
+            sent (bool, optional): List the sent box instead of the inbox
+            no (int, optional): Maximum number of mails to fetch
+            before (int, optional): Page cursor from ``list_mail``
+            
+        Returns:
+            list: Mail rows ``[id, from, to, type, data]``
+            None: If request fails
+        """
+        page = self.list_mail(sent, no, before, headers=False)
+        if page is None:
+            return None
+        # one MGMA round-trip for the whole page instead of one GMA per mail
+        return self.MGMA(page[0])
+
+
+class AsyncClient:
+    """asyncio YCAP client that pipelines commands over one logged-in connection.
+
+    Every packet carries a ``request_id`` that the server echoes back, so any number of
+    commands can be in flight at once and each response resolves the call that sent it.
+    Start many calls together to pay one round-trip for all of them::
+
+        async with AsyncClient("localhost", 1200, "alice^ycap.com", "pw") as client:
+            mails = await asyncio.gather(*(client.GMA(mail_id) for mail_id in ids))
+
+    Speaks framed YCAP and negotiates codecs and compression like Client. Servers that do
+    not echo ``request_id`` answer in order, and their responses resolve the oldest call.
+
+    Args:
+        host (str): YCAP server host
+        port (int): YCAP server port
+        mailaddress (str): Account to log in as
+        password (str): Account password
+        key_file (str, optional): File holding the YCAP master key; defaults to ``YCAP_KEY``
+        codecs (tuple): Packet codecs to offer, most preferred first
+        compression (tuple): Body compressions to offer, most preferred first
+        max_in_flight (int): Most commands waiting for a response at once
+        ticket (str, optional): Resumption ticket from an earlier login, tried before the password
+        metrics (Metrics, optional): Where command latencies and bytes are recorded; a fresh
+            one in ``client.metrics`` when omitted
+    """
+
+    def __init__(self, host, port, mailaddress, password, key_file=None, codecs=("binary", "json"),
+                 compression=("zlib", "lzma"), max_in_flight=256, ticket=None, metrics=None):
+        self.host = host
+        self.port = port
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.emailaddress = mailaddress
+        self.password = password
+        self.key_file = key_file
+        self.codecs = list(codecs)
+        self.codec = JSON_CODEC
+        self.compressions = list(compression)
+        self.compression = None
+        self.max_in_flight = max_in_flight
+        self.ticket = ticket
+        self.channel = None
+        self.key = None
+        self.pending = {}
+        self.next_request_id = 0
+        self.reader_task = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.nrizz()
+
+    async def connect(self):
+        """Open the connection and log in; raises NotImplementedError for unknown users like Client."""
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        self.channel = AsyncFramedChannel(reader, writer)
+        self.channel.metrics = self.metrics
+        response_packet = None
+        if self.ticket is not None:
+            await self.channel.send(json.dumps({"resume":self.ticket, "codecs":self.codecs,
+                                                "compression":self.compressions}).encode())
+            response_packet = json.loads((await self.channel.recv()).decode())
+        if response_packet is None or response_packet[0] != "SESSION RESUMED":
+            await self.channel.send(self.emailaddress.encode())
+            cipher = fernet.Fernet(ycap_fernet(self.key_file).decrypt(await self.channel.recv()))
+            credentials = cipher.encrypt(self.password.encode()).decode()
+            await self.channel.send(json.dumps({"credentials":credentials, "codecs":self.codecs,
+                                                "compression":self.compressions, "tickets":True}).encode())
+            response_packet = json.loads((await self.channel.recv()).decode())
+            if response_packet[0] != "USER SECURELY VERIFIED":
+                await self.channel.send(json.dumps(["QUIT"]).encode())
+                self.channel.close()
+                raise NotImplementedError("USER NOT IN SERVER DB")
+        options = response_packet[1] if len(response_packet) > 1 else {}
+        self.codec = choose_codec([options.get("codec")])
+        self.compression = options.get("compression")
+        self.ticket = options.get("ticket", self.ticket)
+        self.key = (await self.channel.recv()).decode()
+        self.slots = asyncio.Semaphore(self.max_in_flight)
+        self.reader_task = asyncio.create_task(self._read_responses())
+        return self
+
+    async def _read_responses(self):
+        error = ConnectionError("YCAP connection closed")
+        try:
+            while True:
+                data = await self.channel.recv()
+                if not data:
+                    break
+                packet = self.codec.decode(data)
+                if packet.get("command") == PUSH_COMMAND:
+                    continue
+                request_id = packet.get("request_id")
+                if request_id is None and self.pending:
+                    # the server answers in order when it does not echo ids
+                    request_id = next(iter(self.pending))
+                future = self.pending.pop(request_id, None)
+                if future is not None and not future.done():
+                    future.set_result(packet)
+        except Exception as e:
+            error = e
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self.pending.clear()
+
+    async def request(self, command, arguments):
+        """Send one command and wait for its response packet, letting other calls run meanwhile."""
+        async with self.slots:
+            if self.reader_task.done():
+                raise ConnectionError("YCAP connection closed")
+            self.next_request_id += 1
+            request_id = self.next_request_id
+            future = asyncio.get_running_loop().create_future()
+            self.pending[request_id] = future
+            packet = {
+                "connection_key": self.key,
+                "command": command,
+                "arguments": arguments,
+                "request_id": request_id
+            }
+            with self.metrics.time_command(command):
+                try:
+                    async with self.channel.send_lock:
+                        await self.channel.send(self.codec.encode(packet))
+                except Exception:
+                    self.pending.pop(request_id, None)
+                    raise
+                return await future
+
+    async def noop(self):
+        answer_packet = await self.request("NOOP", ["NOOP"])
+        return answer_packet.get("return")[0] == "NOOP"
+
+    async def nrizz(self):
+        """Log out and close the connection."""
+        if self.reader_task is None or self.reader_task.done():
+            self.channel.close()
+            return False
+        try:
+            answer_packet = await self.request("NRIZZ", ["GOODBYE"])
+            return answer_packet.get("return")[0] == "GOODBYE"
+        finally:
+            self.channel.close()
+            self.reader_task.cancel()
+
+    async def send_mail(self, to_addr, mail_type, mail_data):
+        """Send an email with YAP; same arguments and response as Client.send_mail."""
+        if not isinstance(to_addr, str):
+            to_addr = list(to_addr)
+        arguments = [[self.emailaddress, to_addr], mail_type, mail_data]
+        body, encoding = compress_body(mail_data, self.compression)
+        if encoding is not None:
+            arguments[2:] = [body_to_wire(body, self.codec), encoding]
+        answer_packet = await self.request("YAP", arguments)
+        if answer_packet.get("return")[0] == "MAIL_NOT_SENT":
+            warnings.warn(f"Due to '{answer_packet.get('return')[1]}' mail is not sent")
+        return answer_packet
+
+    async def GMA(self, id):
+        """Fetch one mail as ``[id, from, to, type, data]``, or None if it does not exist."""
+        answer_packet = await self.request("GMA", [id])
+        rows = answer_packet.get("return")
+        return Client._open_mail(rows[0]) if rows else None
+
+    async def MGMA(self, ids):
+        answer_packet = await self.request("MGMA", [list(ids)])
+        return [Client._open_mail(row) for row in answer_packet.get("return")]
+
+    async def NYAP(self, id):
+        return await self.request("NYAP", [id])
+
+    async def list_mail(self, sent=False, limit=50, before=None, headers=True):
+        answer_packet = await self.request("LYAP", [sent, limit, before, headers])
+        return answer_packet.get("return"), answer_packet.get("cursor")
+
+    async def search(self, query, limit=50, before=None):
+        answer_packet = await self.request("SEARCH", [query, limit, before])
+        return answer_packet.get("return"), answer_packet.get("cursor")
+
+    async def get_mail(self, sent=False, no=10, before=None):
+        """One page of ``no`` mails, newest first, with LYAP and one MGMA like Client.get_mail."""
+        ids, _ = await self.list_mail(sent, no, before, headers=False)
+        return await self.MGMA(ids)
+
+
+class ClientPool:
+    """Thread-safe pool of logged-in Clients shared across callers.
+
+    Clients are keyed by account, so a web app can reuse one authenticated YCAP session
+    across many HTTP requests instead of paying a connect, handshake and login each time.
+    A checked-out client is never handed to a second caller until it is released.
+
+    Args:
+        max_size (int): Cap on open clients, idle and checked out together
+        idle_timeout (float): Seconds an idle client is kept before it is closed
+        health_check_after (float): Idle seconds after which a client is pinged with NOOP before reuse
+        acquire_timeout (float): Seconds to wait for a free slot when the pool is full
+
+    Every pooled client records into the pool's shared ``metrics``.
+    """
+
+    def __init__(self, max_size=32, idle_timeout=300.0, health_check_after=30.0, acquire_timeout=10.0):
+        self.metrics = Metrics()
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.lock = threading.Condition()
+        self.idle = {}
+        self.owners = {}
+        # latest resumption ticket per account, so reconnects after eviction skip the login
+        self.tickets = {}
+        self.connecting = 0
+
+    @contextmanager
+    def client(self, host, port, mailaddress, password, **client_kwargs):
+        """Check out a logged-in Client for the duration of a ``with`` block.
+
+        A client that raised inside the block is closed instead of going back to the pool.
+        """
+        client = self.acquire(host, port, mailaddress, password, **client_kwargs)
+        try:
+            yield client
+        except Exception:
+            self.discard(client)
+            raise
+        else:
+            self.release(client)
+
+    def acquire(self, host, port, mailaddress, password, **client_kwargs):
+        key = (host, port, mailaddress, password)
+        while True:
+            with self.lock:
+                self._evict_idle()
+                entries = self.idle.get(key)
+                if entries:
+                    client, last_used = entries.pop()
+                else:
+                    client = None
+                    self._reserve_slot()
+            if client is None:
+                break
+            if time.monotonic() - last_used < self.health_check_after or self._healthy(client):
+                return client
+            self.discard(client)
+        try:
+            client_kwargs.setdefault("metrics", self.metrics)
+            client = Client(host, port, mailaddress, password, ticket=self.tickets.get(key), **client_kwargs)
+        except Exception:
+            with self.lock:
+                self.connecting -= 1
+                self.lock.notify()
+            raise
+        with self.lock:
+            self.connecting -= 1
+            self.owners[id(client)] = key
+            if client.ticket is not None:
+                self.tickets[key] = client.ticket
+        return client
+
+    def dedicated(self, host, port, mailaddress, password, **client_kwargs):
+        """Open a Client the pool does not hold, for long-lived use such as a push subscription.
+
+        It resumes with the account's latest pooled ticket when it can, so it skips the login
+        like a pooled reconnect. The caller closes it.
+        """
+        key = (host, port, mailaddress, password)
+        client_kwargs.setdefault("metrics", self.metrics)
+        client = Client(host, port, mailaddress, password, ticket=self.tickets.get(key), **client_kwargs)
+        if client.ticket is not None:
+            with self.lock:
+                self.tickets[key] = client.ticket
+        return client
+
+    def release(self, client):
+        with self.lock:
+            key = self.owners.get(id(client))
+            if key is None:
+                return
+            self.idle.setdefault(key, []).append((client, time.monotonic()))
+            self.lock.notify()
+
+    def discard(self, client):
+        with self.lock:
+            self.owners.pop(id(client), None)
+            self.lock.notify()
+        client.close()
+
+    def close_account(self, host, port, mailaddress):
+        """Log out and close every idle client of one account (e.g. on web logout)."""
+        with self.lock:
+            closing = []
+            for key in [k for k in self.idle if k[:3] == (host, port, mailaddress)]:
+                closing.extend(client for client, _ in self.idle.pop(key))
+            for key in [k for k in self.tickets if k[:3] == (host, port, mailaddress)]:
+                del self.tickets[key]
+        for client in closing:
+            try:
+                client.nrizz()
+            except Exception:
+                pass
+            self.discard(client)
+
+    def _reserve_slot(self):
+        # caller holds the lock
+        deadline = time.monotonic() + self.acquire_timeout
+        while len(self.owners) + self.connecting >= self.max_size:
+            if not self._evict_oldest_idle():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConnectionError("YCAP client pool exhausted")
+                self.lock.wait(remaining)
+        self.connecting += 1
+
+    def _evict_idle(self):
+        now = time.monotonic()
+        for key in list(self.idle):
+            keep = []
+            for client, last_used in self.idle[key]:
+                if now - last_used > self.idle_timeout:
+                    self.owners.pop(id(client), None)
+                    client.close()
+                else:
+                    keep.append((client, last_used))
+            if keep:
+                self.idle[key] = keep
+            else:
+                del self.idle[key]
+
+    def _evict_oldest_idle(self):
+        oldest = None
+        for key, entries in self.idle.items():
+            for index, (client, last_used) in enumerate(entries):
+                if oldest is None or last_used < oldest[2]:
+                    oldest = (key, index, last_used)
+        if oldest is None:
+            return False
+        key, index, _ = oldest
+        client, _ = self.idle[key].pop(index)
+        if not self.idle[key]:
+            del self.idle[key]
+        self.owners.pop(id(client), None)
+        client.close()
+        return True
+
+    @staticmethod
+    def _healthy(client):
+        try:
+            return client.noop()
+        except Exception:
+            return False
@@ -1,9 +1,13 @@
+import argparse
+import asyncio
+import multiprocessing
 import socket
 import threading
 import json
 import sqlite3
 import os
 import time
+import zlib
 from cryptography import fernet
 
 try:
@@ -11,6 +15,18 @@ try:
 except Exception:
     msvcrt = None
 import secrets
+import queue
+import signal
+import tempfile
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from ycap_protocol import (COMPRESSIONS, JSON_CODEC, MAX_FRAME_SIZE, MAX_HANDSHAKE_FRAME_SIZE, PUSH_COMMAND,
+                           STREAM_CHUNK_SIZE, AsyncFramedChannel, ProtocolError, accept_channel, body_from_wire,
+                           body_to_wire, choose_codec, choose_compression, compress_body, decompress_body,
+                           load_ycap_key)
+from ycap_metrics import Metrics, serve_metrics
+from ycap_passwords import LEGACY_PREFIX, PasswordHasher, check_password, hash_password
 
 """
 YCAP Email Protocol Server Implementation
@@ -19,6 +35,28 @@ This module implements the YCAP email server.
 It handles client connections, manages the email database, and processes YCAP protocol commands.
 """
 
+# stay under SQLITE_MAX_VARIABLE_NUMBER of older SQLite builds
+MAX_SQL_VARIABLES = 500
+# largest LYAP page a client can ask for
+MAX_PAGE_SIZE = 1000
+# commands whose mail body travels as raw frames after the command packet
+STREAM_COMMANDS = ("SGMA", "SYAP")
+# streamed uploads beyond this many bytes are spooled to a temporary file
+SPOOL_MEMORY_LIMIT = 1024 * 1024
+# bodies that arrive uncompressed are stored with this compression once they pass COMPRESSION_THRESHOLD
+STORE_COMPRESSION = "zlib"
+# listing boxes LYAP may query: sent box by sender, inbox by recipient
+LIST_COLUMNS = {"from_": "from_", "to_": "to_"}
+# commands timed under their own name; anything else a client sends is counted as UNKNOWN
+COMMANDS = ("YCAP", "NOOP", "NRIZZ", "REVOKE", "SUB", "UNSUB", "LYAP", "GMA", "MGMA", "YAP", "NYAP", "SGMA", "SYAP",
+            "SEARCH")
+# NEW_MAIL pushes a subscriber may have waiting; a session that falls further behind is closed
+MAX_QUEUED_PUSHES = 1024
+# only the first this many bytes of a body are indexed for SEARCH
+SEARCH_INDEX_LIMIT = 1024 * 1024
+# encoding and enough of the stored body for search_text, without loading big plain bodies whole
+SEARCH_BODY = f"encoding, CASE WHEN encoding IS NULL THEN substr(data, 1, {SEARCH_INDEX_LIMIT}) ELSE data END"
+
 def invert_dictionary(dic):
     """Invert a dictionary mapping.
     
@@ -29,101 +67,1500 @@ def invert_dictionary(dic):
         dict: Inverted mapping where values become keys and keys become values
     """
     return {v: k for k, v in dic.items()}
+
+
+def search_text(data, encoding):
+    """Body text as the search index holds it: unpacked and cut at SEARCH_INDEX_LIMIT.
+
+    A contentless FTS5 index only forgets a row when given the exact text it indexed, so
+    indexing and unindexing both go through here.
+
+    Args:
+        data (str | bytes): Stored body, or its first SEARCH_INDEX_LIMIT bytes if not compressed
+        encoding (str): Compression of the stored body, or None
+    """
+    if data is None:
+        return ""
+    if encoding is not None:
+        try:
+            data = COMPRESSIONS[encoding].decompressor().decompress(data, SEARCH_INDEX_LIMIT)
+        except Exception:
+            # a corrupt body stored before YAP checked packed bodies; indexed (and unindexed) as empty
+            data = b""
+    else:
+        data = data[:SEARCH_INDEX_LIMIT]
+    if isinstance(data, bytes):
+        return data.decode("utf-8", "replace")
+    return data
+
+
+def fts_query(text):
+    """Turn free text into an FTS5 query matching mails that contain all of its words.
+
+    Every word is quoted, so FTS5 operators and punctuation in the text are searched for
+    literally instead of raising syntax errors. A trailing ``*`` keeps prefix search.
+
+    Returns:
+        str: FTS5 MATCH expression
+        None: If the text has no words
+    """
+    terms = []
+    for word in str(text).split():
+        prefix = len(word) > 1 and word.endswith("*")
+        word = word.rstrip("*")
+        if word:
+            terms.append('"' + word.replace('"', '""') + '"' + ("*" if prefix else ""))
+    return " ".join(terms) or None
+
+
+def _index_mail(conn, seq, from_, to_, text):
+    conn.execute("INSERT INTO mail_search (rowid, from_, to_, body) VALUES (?, ?, ?, ?)", (seq, from_, to_, text))
+
+
+def _migration_1(db):
+    """Token-keyed mail table with listing indexes.
+
+    ``seq`` is the insertion order that LYAP pages on and ``id`` is the mail token.
+    Rows of an older ``mail(from_, to_, type_, data, id)`` table are copied over in order.
+    """
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL
+        )
+        """)
+    legacy = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='mail'").fetchone()
+    # each migration spells out its own table, so later schema changes never alter what this one builds
+    db.execute("""
+        CREATE TABLE mail_new (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            from_ TEXT NOT NULL,
+            to_ TEXT NOT NULL,
+            type_ TEXT,
+            data TEXT,
+            created_at REAL NOT NULL
+        )
+        """)
+    if legacy:
+        # older tables may hold rows without a token; give them one
+        db.execute("""
+            INSERT OR IGNORE INTO mail_new (id, from_, to_, type_, data, created_at)
+            SELECT COALESCE(id, lower(hex(randomblob(8)))), COALESCE(from_, ''), COALESCE(to_, ''), type_, data, ?
+            FROM mail ORDER BY rowid
+            """, [time.time()])
+        db.execute("DROP TABLE mail")
+    db.execute("ALTER TABLE mail_new RENAME TO mail")
+    db.execute("CREATE INDEX mail_recipient_time ON mail (to_, seq)")
+    db.execute("CREATE INDEX mail_sender_time ON mail (from_, seq)")
+
+
+def _migration_2(db):
+    """Move the mail body to the last column.
+
+    SQLite only keeps a ``zeroblob`` unexpanded when it is the last field of the record, so
+    streamed uploads need ``data`` at the end to reserve their body without allocating it.
+    """
+    db.execute("""
+        CREATE TABLE mail_new (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            from_ TEXT NOT NULL,
+            to_ TEXT NOT NULL,
+            type_ TEXT,
+            created_at REAL NOT NULL,
+            data TEXT
+        )
+        """)
+    db.execute("""
+        INSERT INTO mail_new (seq, id, from_, to_, type_, created_at, data)
+        SELECT seq, id, from_, to_, type_, created_at, data FROM mail ORDER BY seq
+        """)
+    db.execute("DROP TABLE mail")
+    db.execute("ALTER TABLE mail_new RENAME TO mail")
+    db.execute("CREATE INDEX mail_recipient_time ON mail (to_, seq)")
+    db.execute("CREATE INDEX mail_sender_time ON mail (from_, seq)")
+
+
+def _migration_3(db):
+    """Record the compression of each stored body in ``mail.encoding`` (NULL for plain bodies).
+
+    The table is rebuilt instead of altered so ``data`` stays the last column. Bodies already
+    stored stay uncompressed.
+    """
+    db.execute("""
+        CREATE TABLE mail_new (
+            seq INTEGER PRIMARY KEY,
+            id TEXT NOT NULL UNIQUE,
+            from_ TEXT NOT NULL,
+            to_ TEXT NOT NULL,
+            type_ TEXT,
+            created_at REAL NOT NULL,
+            encoding TEXT,
+            data TEXT
+        )
+        """)
+    db.execute("""
+        INSERT INTO mail_new (seq, id, from_, to_, type_, created_at, data)
+        SELECT seq, id, from_, to_, type_, created_at, data FROM mail ORDER BY seq
+        """)
+    db.execute("DROP TABLE mail")
+    db.execute("ALTER TABLE mail_new RENAME TO mail")
+    db.execute("CREATE INDEX mail_recipient_time ON mail (to_, seq)")
+    db.execute("CREATE INDEX mail_sender_time ON mail (from_, seq)")
+
+
+def _migration_4(db):
+    """Revocation state for session resumption tickets.
+
+    ``users.tickets_not_before`` revokes every ticket of a user issued before it, and
+    ``revoked_tickets`` holds single tickets revoked on logout until they expire anyway.
+    """
+    db.execute("ALTER TABLE users ADD COLUMN tickets_not_before REAL NOT NULL DEFAULT 0")
+    db.execute("""
+        CREATE TABLE revoked_tickets (
+            id TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        )
+        """)
+
+
+def _migration_5(db):
+    """Full-text search index over mail senders, recipients and bodies.
+
+    ``mail_search`` is a contentless FTS5 table whose rowid is ``mail.seq``. Bodies are stored
+    compressed, so MailStore feeds the index their unpacked text (see search_text) in the
+    same transaction as each insert and delete. Existing mail is indexed here.
+    """
+    db.execute("CREATE VIRTUAL TABLE mail_search USING fts5(from_, to_, body, content='')")
+    for seq, from_, to_, encoding, data in db.execute(f"SELECT seq, from_, to_, {SEARCH_BODY} FROM mail"):
+        _index_mail(db, seq, from_, to_, search_text(data, encoding))
+
+
+def _migration_6(db):
+    """Mark the plaintext passwords stored so far as legacy rows.
+
+    Hashing every row here would run the KDF once per account before the server could start.
+    Tagging them is cheap, and each one is replaced by a hash at its next successful login
+    (see ycap_passwords).
+    """
+    db.execute("UPDATE users SET password = ? || password", [LEGACY_PREFIX])
+
+
+def _migration_7(db):
+    """Never hand out a ``seq`` twice.
+
+    Without AUTOINCREMENT SQLite reuses the rowid of the newest mail once it is deleted, so
+    the next mail would get a seq the polled mail feed has already passed and a search entry
+    could point at it. The table is rebuilt with ``seq INTEGER PRIMARY KEY AUTOINCREMENT``;
+    seqs of existing mail, which the search index is keyed on, are kept.
+    """
+    db.execute("""
+        CREATE TABLE mail_new (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            from_ TEXT NOT NULL,
+            to_ TEXT NOT NULL,
+            type_ TEXT,
+            created_at REAL NOT NULL,
+            encoding TEXT,
+            data TEXT
+        )
+        """)
+    db.execute("""
+        INSERT INTO mail_new (seq, id, from_, to_, type_, created_at, encoding, data)
+        SELECT seq, id, from_, to_, type_, created_at, encoding, data FROM mail ORDER BY seq
+        """)
+    db.execute("DROP TABLE mail")
+    db.execute("ALTER TABLE mail_new RENAME TO mail")
+    db.execute("CREATE INDEX mail_recipient_time ON mail (to_, seq)")
+    db.execute("CREATE INDEX mail_sender_time ON mail (from_, seq)")
+
+
+# index i upgrades a database from user_version i to i + 1
+SCHEMA_MIGRATIONS = [_migration_1, _migration_2, _migration_3, _migration_4, _migration_5, _migration_6,
+                     _migration_7]
+
+
+def migrate_schema(db):
+    """Upgrade a mails.db in place to the newest schema.
+
+    The schema version lives in ``PRAGMA user_version``; every migration runs in its own
+    transaction together with its version bump, so an interrupted upgrade is rolled back.
+
+    Args:
+        db (sqlite3.Connection): Open database connection
+
+    Returns:
+        int: Schema version after the upgrade
+    """
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    for number in range(version, len(SCHEMA_MIGRATIONS)):
+        db.execute("BEGIN")
+        try:
+            SCHEMA_MIGRATIONS[number](db)
+            db.execute(f"PRAGMA user_version = {number + 1}")
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+    return max(version, len(SCHEMA_MIGRATIONS))
+
+
+def shard_of(address, shards):
+    """Index of the shard holding the inbox of ``address``; the same in every process and run."""
+    return zlib.crc32(address.encode()) % shards
+
+
+def shard_path(db_path, index):
+    """File of shard ``index`` next to the main database: ``mails.db`` -> ``mails.shard0.db``."""
+    root, ext = os.path.splitext(db_path)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def _claim_shard(db, index, shards):
+    """Record in a shard file which shard of how many it is, or check the record matches."""
+    db.execute("CREATE TABLE IF NOT EXISTS shard_info (shard INTEGER NOT NULL, shards INTEGER NOT NULL)")
+    row = db.execute("SELECT shard, shards FROM shard_info").fetchone()
+    if row is None:
+        db.execute("INSERT INTO shard_info (shard, shards) VALUES (?, ?)", [index, shards])
+    elif tuple(row) != (index, shards):
+        raise ValueError(f"Database is shard {row[0]} of {row[1]}, not shard {index} of {shards}")
+
+
+def _page(rows, limit):
+    """Cut ``limit + 1`` newest-first ``(seq, ...)`` rows to a page and the cursor of the next one."""
+    cursor = rows[limit - 1][0] if len(rows) > limit else None
+    return rows[:limit], cursor
+
+
+class MailStore:
+    """SQLite storage for users and mail.
+
+    The database runs in WAL mode, so readers never wait for the writer. Reads borrow a
+    connection from a small pool. Every write goes through one writer thread that
+    group-commits: writes arriving within ``commit_window`` seconds of each other share one
+    transaction and one fsync. Each write runs in its own savepoint, so a failing write
+    does not take its batch down, and callers only get their result after the commit.
+
+    Args:
+        path (str): SQLite database file, upgraded to the current schema on open
+        readers (int): Number of pooled read connections
+        commit_window (float): Seconds the writer waits to gather more writes into a batch
+        max_batch (int): Most writes committed in one transaction
+        metrics (Metrics, optional): Receives ``db_reader_wait``, ``db_read`` and ``db_commit`` timings
+        shard (tuple, optional): ``(index, shards)`` when this file is one shard of a ShardedMailStore
+    """
+
+    def __init__(self, path="mails.db", readers=4, commit_window=0.002, max_batch=256, metrics=None, shard=None):
+        self.path = path
+        self.shard = shard
+        self.metrics = metrics
+        self.commit_window = commit_window
+        self.max_batch = max_batch
+        self.wdb = sqlite3.connect(path, check_same_thread=False)
+        self.wdb.execute("PRAGMA journal_mode=WAL")
+        migrate_schema(self.wdb)
+        # the writer manages its transactions by hand
+        self.wdb.isolation_level = None
+        if shard is not None:
+            _claim_shard(self.wdb, *shard)
+        self.readers = queue.Queue()
+        for _ in range(readers):
+            conn = sqlite3.connect(path, check_same_thread=False)
+            conn.execute("PRAGMA query_only=1")
+            self.readers.put(conn)
+        self.reader_count = readers
+        self.writes = queue.Queue()
+        self.writer = threading.Thread(target=self._write_loop, name="ycap-db-writer", daemon=True)
+        self.writer.start()
+
+    @contextmanager
+    def reader(self):
+        """Borrow a read connection for the duration of a ``with`` block."""
+        started = time.perf_counter()
+        conn = self.readers.get()
+        borrowed = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+            if self.metrics is not None:
+                self.metrics.observe("db_reader_wait", borrowed - started)
+                self.metrics.observe("db_read", time.perf_counter() - borrowed)
+
+    def read(self, query, params=()):
+        with self.reader() as conn:
+            return conn.execute(query, params).fetchall()
+
+    def submit_write(self, operation):
+        """Queue ``operation(conn)`` for the writer thread.
+
+        Returns:
+            Future: Resolves to the operation's return value once its batch is committed
+        """
+        future = Future()
+        self.writes.put((future, operation))
+        return future
+
+    def write(self, query, params=()):
+        """Run one write statement in the next group commit and wait for it.
+
+        Returns:
+            int: Number of rows the statement changed
+        """
+        return self.submit_write(lambda conn: conn.execute(query, params).rowcount).result()
+
+    def _write_loop(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.commit_window
+            stopping = False
+            while len(batch) < self.max_batch:
+                try:
+                    item = self.writes.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+            if stopping:
+                return
+
+    def _commit_batch(self, batch):
+        started = time.perf_counter()
+        try:
+            self._run_batch(batch)
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe("db_commit", time.perf_counter() - started)
+
+    def _run_batch(self, batch):
+        outcomes = []
+        # take the write lock up front: with several server processes on one database a
+        # deferred transaction could fail on a snapshot another process has moved past
+        try:
+            self.wdb.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error as e:
+            # another process held the lock past the busy timeout; fail this batch, keep the writer
+            for future, _ in batch:
+                future.set_exception(e)
+            return
+        for future, operation in batch:
+            self.wdb.execute("SAVEPOINT write_op")
+            try:
+                outcomes.append((future, operation(self.wdb), None))
+                self.wdb.execute("RELEASE write_op")
+            except Exception as e:
+                self.wdb.execute("ROLLBACK TO write_op")
+                self.wdb.execute("RELEASE write_op")
+                outcomes.append((future, None, e))
+        try:
+            self.wdb.execute("COMMIT")
+        except Exception as e:
+            self.wdb.execute("ROLLBACK")
+            for future, _, _ in outcomes:
+                future.set_exception(e)
+            return
+        for future, result, error in outcomes:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """Flush pending writes and close every connection."""
+        self.writes.put(None)
+        self.writer.join()
+        self.wdb.close()
+        for _ in range(self.reader_count):
+            self.readers.get().close()
+
+    # users
+
+    def get_password(self, username):
+        rows = self.read("SELECT password FROM users WHERE username=?", [username])
+        return rows[0][0] if rows else None
+
+    def user_exists(self, username):
+        return self.read("SELECT 1 FROM users WHERE username=?", [username]) != []
+
+    def create_user(self, username, password):
+        """Add an account; ``password`` is the stored form from ycap_passwords, never the clear text."""
+        self.write("INSERT INTO users (username, password) VALUES (?,?)", [username, password])
+
+    def set_password(self, username, password, previous):
+        """Replace a stored password, unless it changed since ``previous`` was read."""
+        self.write("UPDATE users SET password=? WHERE username=? AND password=?", [password, username, previous])
+
+    # session tickets
+
+    def ticket_usable(self, username, ticket_id, issued_at):
+        """Check a resumption ticket against user-wide and single-ticket revocation in one query."""
+        rows = self.read("""
+            SELECT tickets_not_before <= ? AND NOT EXISTS (SELECT 1 FROM revoked_tickets WHERE id=?)
+            FROM users WHERE username=?
+            """, [issued_at, ticket_id, username])
+        return bool(rows and rows[0][0])
+
+    def revoke_ticket(self, ticket_id, expires_at):
+        """Revoke one ticket; tickets past their expiry are dropped from the table on the way."""
+        def operation(conn):
+            conn.execute("DELETE FROM revoked_tickets WHERE expires_at < ?", [time.time()])
+            conn.execute("INSERT OR IGNORE INTO revoked_tickets (id, expires_at) VALUES (?, ?)", [ticket_id, expires_at])
+
+        self.submit_write(operation).result()
+
+    def revoke_tickets(self, username):
+        """Revoke every ticket issued to ``username`` so far."""
+        self.write("UPDATE users SET tickets_not_before=? WHERE username=?", [time.time(), username])
+
+    # mail
+
+    def new_mail_id(self):
+        """Fresh mail token; a shard appends its index so lookups by id know where to go."""
+        if self.shard is None:
+            return secrets.token_hex(8)
+        return f"{secrets.token_hex(8)}-{self.shard[0]}"
+
+    def _next_seq(self, conn):
+        """seq for the next insert on the writer connection; None lets SQLite pick it.
+
+        Shards hand out seqs that are unique across all shards (``seq % shards`` is the shard
+        index) and follow the clock (microseconds times shards), so pages merged from several
+        shards come out newest first and one integer cursor pages them all.
+        """
+        if self.shard is None:
+            return None
+        index, shards = self.shard
+        # highest seq ever handed out, deleted mail included (see _migration_7)
+        last = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM sqlite_sequence WHERE name = 'mail'").fetchone()[0]
+        seq = max(last + 1, time.time_ns() // 1000 * shards)
+        return seq + (index - seq) % shards
+
+    def list_ids(self, column, address):
+        """All mail ids of one sent box (``from_``) or inbox (``to_``), oldest first."""
+        return [row[0] for row in self.read(f"SELECT id FROM mail WHERE {LIST_COLUMNS[column]}=? ORDER BY seq", [address])]
+
+    def list_page(self, column, address, limit, before, headers):
+        """Run one newest-first page of a LYAP listing.
+
+        Pages are keyed on insertion order (seq) through the recipient/sender indexes, so deep
+        pages cost the same as the first.
+
+        Args:
+            column (str): ``from_`` for the sent box, ``to_`` for the inbox
+            address (str): Mail address of the session owner
+            limit (int): Page size, capped at MAX_PAGE_SIZE
+            before (int, optional): Cursor from the previous page
+            headers (bool): Return ``[id, from, to, type]`` rows instead of bare ids
+
+        Returns:
+            tuple: (ids or header rows, cursor of the next page or None on the last page)
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        rows, cursor = _page(self.list_rows(column, address, limit, before, headers), limit)
+        if headers:
+            return [list(row[1:]) for row in rows], cursor
+        return [row[1] for row in rows], cursor
+
+    def list_rows(self, column, address, limit, before, headers):
+        """Newest-first ``(seq, id[, from, to, type])`` rows for list_page, one more than ``limit``."""
+        columns = "seq, id, from_, to_, type_" if headers else "seq, id"
+        query = f"SELECT {columns} FROM mail WHERE {LIST_COLUMNS[column]}=?"
+        params = [address]
+        if before is not None:
+            query += " AND seq<?"
+            params.append(int(before))
+        query += " ORDER BY seq DESC LIMIT ?"
+        # one extra row tells us whether another page exists
+        return self.read(query, params + [limit + 1])
+
+    def get_mails(self, mail_ids):
+        """Fetch many mails with one ``WHERE id IN (...)`` query per batch.
+
+        Args:
+            mail_ids (list): Mail ids to fetch
+
+        Returns:
+            list: ``[id, from, to, type, data, encoding]`` rows in the order of ``mail_ids``, with
+            ``data`` as stored; unknown ids are skipped
+        """
+        found = {}
+        with self.reader() as conn:
+            for start in range(0, len(mail_ids), MAX_SQL_VARIABLES):
+                batch = mail_ids[start:start + MAX_SQL_VARIABLES]
+                query = f"SELECT id, from_, to_, type_, data, encoding FROM mail WHERE id IN ({','.join('?' * len(batch))})"
+                for row in conn.execute(query, batch).fetchall():
+                    found[row[0]] = list(row)
+        return [found[mail_id] for mail_id in mail_ids if mail_id in found]
+
+    def mail_header(self, mail_id):
+        """Look up a mail for streaming without loading its body.
+
+        Returns:
+            tuple: (``[id, from, to, type, stored body size in bytes]``, seq, encoding) or None for an unknown id
+        """
+        with self.reader() as conn:
+            # typeof() reads only the record header; "data IS NULL" would load the whole body
+            row = conn.execute("SELECT seq, id, from_, to_, type_, encoding, typeof(data) FROM mail WHERE id=?",
+                               [mail_id]).fetchone()
+            if row is None:
+                return None
+            size = 0
+            if row[6] != "null":
+                with conn.blobopen("mail", "data", row[0], readonly=True) as blob:
+                    size = len(blob)
+        return list(row[1:5]) + [size], row[0], row[5]
+
+    def read_body_chunk(self, seq, offset, length):
+        """Read part of a mail body with SQLite incremental blob I/O."""
+        with self.reader() as conn:
+            with conn.blobopen("mail", "data", seq, readonly=True) as blob:
+                blob.seek(offset)
+                return blob.read(length)
+
+    def insert_mail_stream(self, from_, to_, mail_type, body, size):
+        """Store a mail whose body is read from a file object in chunks.
+
+        The row is inserted with a ``zeroblob`` of the final size and filled through an
+        incremental blob handle, so the body is never held in memory as a whole.
+
+        Returns:
+            str: New mail id
+        """
+        mail_id = self.new_mail_id()
+
+        def operation(conn):
+            seq = conn.execute("INSERT INTO mail (seq, from_, to_, type_, data, id, created_at) VALUES (?, ?, ?, ?, zeroblob(?), ?, ?)",
+                               (self._next_seq(conn), from_, to_, mail_type, size, mail_id, time.time())).lastrowid
+            body.seek(0)
+            _index_mail(conn, seq, from_, to_, search_text(body.read(SEARCH_INDEX_LIMIT), None))
+            body.seek(0)
+            with conn.blobopen("mail", "data", seq) as blob:
+                for chunk in iter(lambda: body.read(STREAM_CHUNK_SIZE), b""):
+                    blob.write(chunk)
+            return mail_id
+
+        return self.submit_write(operation).result()
+
+    def insert_mail(self, from_, to_, mail_type, mail_data, encoding=None, text=None):
+        """Store one mail and return its new mail id.
+
+        ``encoding`` names the compression ``mail_data`` is packed with (None for plain bodies).
+        ``text`` is the body text for the search index, if the caller already has it unpacked.
+        """
+        mail_id = self.new_mail_id()
+        if text is None:
+            # unpack for the index here, not on the writer thread every other write waits for
+            text = search_text(mail_data, encoding)
+
+        def operation(conn):
+            seq = conn.execute("INSERT INTO mail (seq, from_, to_, type_, data, encoding, id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                               (self._next_seq(conn), from_, to_, mail_type, mail_data, encoding, mail_id, time.time())).lastrowid
+            _index_mail(conn, seq, from_, to_, text)
+            return mail_id
+
+        return self.submit_write(operation).result()
+
+    def existing_users(self, usernames):
+        """Return the subset of ``usernames`` that are registered, using one query per batch."""
+        found = set()
+        with self.reader() as conn:
+            for start in range(0, len(usernames), MAX_SQL_VARIABLES):
+                batch = usernames[start:start + MAX_SQL_VARIABLES]
+                query = f"SELECT username FROM users WHERE username IN ({','.join('?' * len(batch))})"
+                found.update(row[0] for row in conn.execute(query, batch).fetchall())
+        return found
+
+    def insert_mails(self, from_, recipients, mail_type, mail_data, encoding=None, text=None):
+        """Store one mail per recipient in a single transaction.
+
+        Returns:
+            dict: New mail id for each recipient
+        """
+        future, mail_ids = self.submit_mails(from_, recipients, mail_type, mail_data, encoding, text)
+        future.result()
+        return mail_ids
+
+    def submit_mails(self, from_, recipients, mail_type, mail_data, encoding=None, text=None):
+        """Queue the inserts of insert_mails without waiting for their commit.
+
+        Args:
+            text (str, optional): Body text for the search index, if the caller already unpacked it
+
+        Returns:
+            tuple: (Future resolving once the mails are committed, new mail id for each recipient)
+        """
+        now = time.time()
+        mail_ids = {to_: self.new_mail_id() for to_ in recipients}
+        if text is None:
+            text = search_text(mail_data, encoding)
+
+        def operation(conn):
+            for to_, mail_id in mail_ids.items():
+                seq = conn.execute("INSERT INTO mail (seq, from_, to_, type_, data, encoding, id, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (self._next_seq(conn), from_, to_, mail_type, mail_data, encoding, mail_id, now)).lastrowid
+                _index_mail(conn, seq, from_, to_, text)
+
+        return self.submit_write(operation), mail_ids
+
+    def delete_mail(self, mail_id):
+        """Delete one mail and its search index entry; returns False if no mail had that id."""
+        def operation(conn):
+            row = conn.execute(f"SELECT seq, from_, to_, {SEARCH_BODY} FROM mail WHERE id = ?", [mail_id]).fetchone()
+            if row is None:
+                return False
+            seq, from_, to_, encoding, data = row
+            conn.execute("INSERT INTO mail_search (mail_search, rowid, from_, to_, body) VALUES ('delete', ?, ?, ?, ?)",
+                         (seq, from_, to_, search_text(data, encoding)))
+            conn.execute("DELETE FROM mail WHERE seq = ?", [seq])
+            return True
+
+        return self.submit_write(operation).result()
+
+    def search(self, address, query, limit, before=None):
+        """Run one newest-first page of a SEARCH over the mail ``address`` sent or received.
+
+        Args:
+            address (str): Mail address of the session owner
+            query (str): Words that must all appear in the sender, recipient or body
+            limit (int): Page size, capped at MAX_PAGE_SIZE
+            before (int, optional): Cursor from the previous page
+
+        Returns:
+            tuple: (``[id, from, to, type]`` rows, cursor of the next page or None on the last page)
+        """
+        limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+        rows, cursor = _page(self.search_rows(address, query, limit, before), limit)
+        return [list(row[1:]) for row in rows], cursor
+
+    def search_rows(self, address, query, limit, before=None):
+        """Newest-first ``(seq, id, from, to, type)`` rows for search, one more than ``limit``."""
+        match = fts_query(query)
+        if match is None:
+            return []
+        # the owner's address is part of MATCH so FTS5 only visits this user's mail, not every
+        # user's hits; the exact address check below drops addresses that merely contain it
+        owner = '"' + address.replace('"', '""') + '"'
+        match = f"{{from_ to_}} : {owner} AND ({match})"
+        sql = """
+            SELECT mail.seq, mail.id, mail.from_, mail.to_, mail.type_
+            FROM mail_search JOIN mail ON mail.seq = mail_search.rowid
+            WHERE mail_search MATCH ? AND (mail.to_ = ? OR mail.from_ = ?)
+            """
+        params = [match, address, address]
+        if before is not None:
+            sql += " AND mail_search.rowid < ?"
+            params.append(int(before))
+        sql += " ORDER BY mail_search.rowid DESC LIMIT ?"
+        return self.read(sql, params + [limit + 1])
+
+    def last_seq(self):
+        """Feed position of the newest mail stored so far (see mails_after)."""
+        return self.read("SELECT COALESCE(MAX(seq), 0) FROM mail")[0][0]
+
+    def mails_after(self, seq, limit=1000):
+        """Headers of mails stored after feed position ``seq``, oldest first.
+
+        Returns:
+            tuple: (``[id, from, to, type]`` rows, feed position to pass next time)
+        """
+        rows = self.read("SELECT seq, id, from_, to_, type_ FROM mail WHERE seq > ? ORDER BY seq LIMIT ?",
+                         [seq, limit])
+        return [list(row[1:]) for row in rows], rows[-1][0] if rows else seq
+
+
+class ShardedMailStore(MailStore):
+    """MailStore that spreads the mail table over several SQLite files.
+
+    Users and tickets stay in the main database at ``path``; mail lives in ``shards`` files
+    next to it (see shard_path), each with its own writer thread, so YAPs to different
+    shards commit in parallel instead of queueing on one database lock. A mail is stored in
+    the shard of its recipient (see shard_of), so an inbox is read from one shard. Sent
+    boxes and SEARCH span every shard and are merged by seq, which is unique across shards.
+    New mail ids end in ``-<shard>``; ids of mail moved over by rebalance_shards have no
+    suffix and are looked up in every shard.
+
+    The main database must not hold mail of its own: move it with rebalance_shards first.
+
+    Args:
+        path (str): Main SQLite database file
+        shards (int): Number of shard files
+        **options: MailStore arguments (``readers``, ``commit_window``, ...), used for every file
+    """
+
+    def __init__(self, path="mails.db", shards=4, **options):
+        super().__init__(path, **options)
+        if self.read("SELECT EXISTS (SELECT 1 FROM mail)")[0][0]:
+            super().close()
+            raise RuntimeError(f"{path} still holds mail; move it into shards with --rebalance first")
+        self.shard_count = shards
+        self.shards = [MailStore(shard_path(path, index), shard=(index, shards), **options)
+                       for index in range(shards)]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        super().close()
+
+    def shard_for(self, address):
+        return self.shards[shard_of(address, self.shard_count)]
+
+    def shards_for_id(self, mail_id):
+        """Shards that may hold ``mail_id``: the one named by its suffix, else all of them."""
+        _, _, suffix = str(mail_id).rpartition("-")
+        if suffix.isdigit() and int(suffix) < self.shard_count:
+            return [self.shards[int(suffix)]]
+        return self.shards
+
+    def _merged(self, rows_per_shard, limit):
+        rows = sorted((row for rows in rows_per_shard for row in rows), key=lambda row: row[0], reverse=True)
+        return rows[:limit + 1]
+
+    def list_ids(self, column, address):
+        if column == "to_":
+            return self.shard_for(address).list_ids(column, address)
+        rows = [row for shard in self.shards
+                for row in shard.read(f"SELECT seq, id FROM mail WHERE {LIST_COLUMNS[column]}=?", [address])]
+        return [row[1] for row in sorted(rows)]
+
+    def list_rows(self, column, address, limit, before, headers):
+        if column == "to_":
+            return self.shard_for(address).list_rows(column, address, limit, before, headers)
+        # every shard's newest ``limit + 1`` below the cursor hold the newest ``limit + 1`` overall
+        return self._merged([shard.list_rows(column, address, limit, before, headers) for shard in self.shards],
+                            limit)
+
+    def search_rows(self, address, query, limit, before=None):
+        return self._merged([shard.search_rows(address, query, limit, before) for shard in self.shards], limit)
+
+    def get_mails(self, mail_ids):
+        wanted = {}
+        for mail_id in mail_ids:
+            for shard in self.shards_for_id(mail_id):
+                wanted.setdefault(shard, []).append(mail_id)
+        found = {row[0]: row for shard, ids in wanted.items() for row in shard.get_mails(ids)}
+        return [found[mail_id] for mail_id in mail_ids if mail_id in found]
+
+    def mail_header(self, mail_id):
+        for shard in self.shards_for_id(mail_id):
+            found = shard.mail_header(mail_id)
+            if found is not None:
+                return found
+        return None
+
+    def read_body_chunk(self, seq, offset, length):
+        return self.shards[seq % self.shard_count].read_body_chunk(seq, offset, length)
+
+    def insert_mail_stream(self, from_, to_, mail_type, body, size):
+        return self.shard_for(to_).insert_mail_stream(from_, to_, mail_type, body, size)
+
+    def insert_mail(self, from_, to_, mail_type, mail_data, encoding=None, text=None):
+        return self.shard_for(to_).insert_mail(from_, to_, mail_type, mail_data, encoding, text)
+
+    def insert_mails(self, from_, recipients, mail_type, mail_data, encoding=None, text=None):
+        """Queue the copies on every shard involved at once, then wait for all of them.
+
+        A bulk YAP is atomic per shard, not across shards.
+        """
+        if text is None:
+            text = search_text(mail_data, encoding)
+        groups = {}
+        for to_ in recipients:
+            groups.setdefault(shard_of(to_, self.shard_count), []).append(to_)
+        submitted = [self.shards[index].submit_mails(from_, group, mail_type, mail_data, encoding, text)
+                     for index, group in groups.items()]
+        wait([future for future, _ in submitted])
+        mail_ids = {}
+        for future, ids in submitted:
+            future.result()
+            mail_ids.update(ids)
+        return {to_: mail_ids[to_] for to_ in recipients}
+
+    def delete_mail(self, mail_id):
+        return any(shard.delete_mail(mail_id) for shard in self.shards_for_id(mail_id))
+
+    def last_seq(self):
+        """Feed position: the newest seq of every shard."""
+        return [shard.last_seq() for shard in self.shards]
+
+    def mails_after(self, seq, limit=1000):
+        headers = []
+        position = []
+        for shard, shard_seq in zip(self.shards, seq):
+            shard_headers, shard_seq = shard.mails_after(shard_seq, limit)
+            headers.extend(shard_headers)
+            position.append(shard_seq)
+        return headers, position
+
+
+def open_store(db_path, shards=1, **options):
+    """Open a MailStore, or a ShardedMailStore when ``shards`` is more than 1."""
+    if shards > 1:
+        return ShardedMailStore(db_path, shards, **options)
+    if os.path.exists(shard_path(db_path, 0)):
+        # the mail is in the shard files; one file would serve empty mailboxes
+        raise RuntimeError(f"{db_path} is sharded; start with the --shards it was rebalanced to")
+    return MailStore(db_path, **options)
+
+
+def rebalance_shards(db_path, shards):
+    """Move the mail of a single-file database into ``shards`` shard files (run with the server stopped).
+
+    Each shard is filled in one transaction straight from the main file, bodies and search
+    index included, keeping mail ids so clients' references stay valid. A mail already in its
+    shard is skipped, so an interrupted run can simply be started again. Once every shard has
+    committed, the mail is dropped from the main file, which is then vacuumed; users and
+    tickets stay there.
+
+    Args:
+        db_path (str): Main SQLite database file
+        shards (int): Number of shard files; the server must then run with the same number
+
+    Returns:
+        list: Number of mails in each shard afterwards
+    """
+    if shards < 2:
+        raise ValueError("Sharding needs at least 2 shards")
+    for index in range(shards):
+        # creates, migrates and labels the shard file
+        MailStore(shard_path(db_path, index), readers=1, shard=(index, shards)).close()
+    counts = []
+    with closing(sqlite3.connect(db_path)) as db:
+        db.execute("PRAGMA journal_mode=WAL")
+        migrate_schema(db)
+        db.isolation_level = None
+        db.create_function("ycap_shard", 1, lambda address: shard_of(address, shards), deterministic=True)
+        db.create_function("ycap_search_text", 2, lambda encoding, data: search_text(data, encoding),
+                           deterministic=True)
+        # seq * shards + index keeps the old order and the seq % shards == index rule of the shards
+        moving = """
+            FROM main.mail WHERE ycap_shard(to_) = :index
+            AND NOT EXISTS (SELECT 1 FROM shard.mail WHERE shard.mail.id = main.mail.id)
+            """
+        for index in range(shards):
+            db.execute("ATTACH DATABASE ? AS shard", [shard_path(db_path, index)])
+            try:
+                params = {"index": index, "shards": shards}
+                db.execute("BEGIN IMMEDIATE")
+                try:
+                    # index first: the NOT EXISTS still tells the new mails apart
+                    db.execute(f"""
+                        INSERT INTO shard.mail_search (rowid, from_, to_, body)
+                        SELECT seq * :shards + :index, from_, to_, ycap_search_text({SEARCH_BODY}) {moving}
+                        """, params)
+                    db.execute(f"""
+                        INSERT INTO shard.mail (seq, id, from_, to_, type_, created_at, encoding, data)
+                        SELECT seq * :shards + :index, id, from_, to_, type_, created_at, encoding, data {moving}
+                        """, params)
+                    db.execute("COMMIT")
+                except Exception:
+                    db.execute("ROLLBACK")
+                    raise
+                counts.append(db.execute("SELECT count(*) FROM shard.mail").fetchone()[0])
+            finally:
+                db.execute("DETACH DATABASE shard")
+        db.execute("BEGIN IMMEDIATE")
+        db.execute("DELETE FROM mail")
+        db.execute("INSERT INTO mail_search (mail_search) VALUES ('delete-all')")
+        db.execute("COMMIT")
+        db.execute("VACUUM")
+    return counts
+
+
+class HandshakeCounters:
+    """Thread-safe accept and handshake counters.
+
+    Outcomes are ``completed`` (logged in), ``rejected`` (bad login, signup or quit),
+    ``timed_out`` and ``failed`` (protocol or socket errors).
+    """
+
+    OUTCOMES = ("completed", "rejected", "timed_out", "failed")
+
+    def __init__(self, metrics=None):
+        # handshake latencies also go to metrics as the ``handshake`` timing
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.accepted = 0
+        self.outcomes = dict.fromkeys(self.OUTCOMES, 0)
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def count_accept(self):
+        with self.lock:
+            self.accepted += 1
+
+    def count_handshake(self, outcome, seconds):
+        with self.lock:
+            self.outcomes[outcome] += 1
+            self.latency_total += seconds
+            self.latency_max = max(self.latency_max, seconds)
+        if self.metrics is not None:
+            self.metrics.observe("handshake", seconds)
+
+    def snapshot(self):
+        """Return the counters plus accept rate and handshake latency as a dict."""
+        with self.lock:
+            uptime = time.monotonic() - self.started_at
+            finished = sum(self.outcomes.values())
+            return {
+                "accepted": self.accepted,
+                "accept_rate": self.accepted / uptime if uptime else 0.0,
+                "in_flight": self.accepted - finished,
+                **self.outcomes,
+                "handshake_latency_avg": self.latency_total / finished if finished else 0.0,
+                "handshake_latency_max": self.latency_max,
+            }
+
+
+class Session:
+    """State of one authenticated YCAP connection.
+
+    Each session owns the Fernet cipher negotiated in its handshake, so concurrent
+    handshakes never see each other's keys, the packet codec agreed with its client, and
+    the body compressions the client can unpack (None for clients that did not negotiate).
+    """
+
+    def __init__(self, key, channel, email, cipher):
+        self.key = key
+        self.channel = channel
+        self.email = email
+        self.cipher = cipher
+        self.codec = JSON_CODEC
+        self.compressions = None
+        # resumption ticket the session was opened with or issued
+        self.ticket_id = None
+        self.ticket_expires = None
+        # NEW_MAIL packets waiting for this session's push thread (threaded engine), or None
+        self.pushes = None
+        # pushes the event loop has yet to send (async engine)
+        self.pending_pushes = 0
+        self.created_at = time.monotonic()
+        self.last_active = self.created_at
+
+    def touch(self):
+        """Mark the session active; called for every packet the client sends."""
+        self.last_active = time.monotonic()
+
+
+class ConnectionManager:
+    """Table of live sessions with O(1) lookup by connection key and by channel.
+
+    Sessions leave the table when their connection ends, however it ends. Sessions that
+    have sent nothing for ``idle_timeout`` seconds are handed out by idle_sessions() so the
+    engine can close them, and add() refuses sessions beyond ``max_connections``.
+
+    Args:
+        max_connections (int): Most sessions registered at once
+        idle_timeout (float): Seconds without a packet after which a session counts as idle
+    """
+
+    def __init__(self, max_connections=10000, idle_timeout=900.0):
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.by_key = {}
+        self.by_channel = {}
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def full(self):
+        return len(self.by_key) >= self.max_connections
+
+    def add(self, session):
+        """Register a verified session; returns False when the server is at max_connections."""
+        with self.lock:
+            if len(self.by_key) >= self.max_connections:
+                return False
+            self.by_key[session.key] = session
+            self.by_channel[session.channel] = session
+            return True
+
+    def get(self, key):
+        return self.by_key.get(key)
+
+    def for_channel(self, channel):
+        return self.by_channel.get(channel)
+
+    def remove(self, session):
+        """Drop a session; safe to call more than once."""
+        with self.lock:
+            if self.by_key.get(session.key) is session:
+                del self.by_key[session.key]
+            if self.by_channel.get(session.channel) is session:
+                del self.by_channel[session.channel]
+
+    def sessions(self):
+        with self.lock:
+            return list(self.by_key.values())
+
+    def idle_sessions(self):
+        """Sessions that have been quiet for longer than idle_timeout."""
+        cutoff = time.monotonic() - self.idle_timeout
+        return [session for session in self.sessions() if session.last_active < cutoff]
+
+
+class UserDirectory:
+    """Read-through cache of the users table for recipient checks and logins.
+
+    Accounts are never deleted, so a username once seen in the database stays valid and is
+    kept in a set: YAP recipient checks for known users are memory lookups. Unknown names
+    always go to the database, so accounts signed up through another server process sharing
+    the database are found at once. Stored password records are kept in an LRU of
+    ``max_credentials`` entries; signup and password upgrades in this process update it.
+
+    Args:
+        store (MailStore): Backing storage
+        max_credentials (int): Most password records cached at once
+    """
+
+    def __init__(self, store, max_credentials=4096):
+        self.store = store
+        self.max_credentials = max_credentials
+        self.lock = threading.Lock()
+        self.known = set()
+        self.credentials = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.known)
+
+    def exists(self, username):
+        if username in self.known:
+            self.hits += 1
+            return True
+        self.misses += 1
+        if not self.store.user_exists(username):
+            return False
+        self.known.add(username)
+        return True
+
+    def existing(self, usernames):
+        """Return the subset of ``usernames`` that are registered; only unknown names are queried."""
+        found = {username for username in usernames if username in self.known}
+        missing = [username for username in usernames if username not in found]
+        self.hits += len(found)
+        if missing:
+            self.misses += len(missing)
+            registered = self.store.existing_users(missing)
+            self.known.update(registered)
+            found |= registered
+        return found
+
+    def password(self, username):
+        """Stored password record of ``username``, or None if there is no such user."""
+        with self.lock:
+            stored = self.credentials.get(username)
+            if stored is not None:
+                self.credentials.move_to_end(username)
+                self.hits += 1
+                return stored
+        self.misses += 1
+        stored = self.store.get_password(username)
+        if stored is not None:
+            self.known.add(username)
+            self._remember(username, stored)
+        return stored
+
+    def _remember(self, username, stored):
+        with self.lock:
+            self.credentials[username] = stored
+            self.credentials.move_to_end(username)
+            while len(self.credentials) > self.max_credentials:
+                self.credentials.popitem(last=False)
+
+    def create(self, username, password):
+        """Sign up ``username`` with a stored password record and make it known here at once."""
+        self.store.create_user(username, password)
+        self.known.add(username)
+        self._remember(username, password)
+
+    def set_password(self, username, password, previous):
+        """Upgrade a stored password record (see MailStore.set_password)."""
+        self.store.set_password(username, password, previous)
+        with self.lock:
+            # the update is skipped if the row changed meanwhile; read it back on the next login
+            self.credentials.pop(username, None)
+
         
 class Server:
     """YCAP Server implementation.
     
     Handles client connections, manages email database, and processes YCAP protocol commands.
     Uses SQLite for persistent storage and supports multiple simultaneous client connections.
+
+    The accept thread only accepts sockets; each handshake runs on a bounded worker pool with
+    a per-handshake timeout, so a slow or malicious client cannot stall other logins.
+
+    Args:
+        host (str): Address to listen on
+        port (int): Port to listen on; 0 picks a free port, found in ``server.port`` once ``server.ready`` is set
+        backlog (int): Kernel accept queue length passed to ``listen()``
+        handshake_workers (int): Handshakes run concurrently; further accepts wait for a slot
+        handshake_timeout (float): Seconds a client gets to finish the handshake
+        key_file (str, optional): File holding the YCAP master key; defaults to ``YCAP_KEY``
+        db_path (str): SQLite database file, upgraded to the current schema on start
+        db_readers (int): Pooled SQLite read connections (see MailStore)
+        command_workers (int): Threads running pipelined commands (packets carrying a ``request_id``)
+        max_pipelined (int): Pipelined commands one session may have running at once
+        ticket_ttl (float): Seconds a session resumption ticket stays valid
+        ticket_key (bytes, optional): Fernet key sealing resumption tickets; a fresh key per start
+            when omitted, so a restart invalidates every ticket
+        max_connections (int): Most logged-in sessions at once; further connections are refused
+        idle_timeout (float): Seconds a session may send nothing before the server closes it
+        metrics_port (int, optional): Serve the metrics as text on this loopback port
+        reuse_port (bool): Bind with SO_REUSEPORT so several server processes share the port
+        mail_poll_interval (float, optional): Find new mail for subscribers by polling the database
+            every this many seconds instead of at store time, so mail stored by other server
+            processes sharing the database is pushed too (see run_workers)
+        kdf_workers (int): Processes hashing and checking passwords, so logins never run the KDF
+            on a handshake thread (see ycap_passwords.PasswordHasher)
+        kdf_max_pending (int, optional): Logins and signups that may wait on the KDF pool at once;
+            twice ``kdf_workers`` when omitted
+        user_cache_size (int): Password records kept in memory for logins (see UserDirectory)
+        shards (int): Spread mail over this many SQLite files next to ``db_path`` (see ShardedMailStore)
+
+    Per-command latency, bytes in and out, handshake and database timings and the active
+    session count are recorded in ``server.metrics`` (see ycap_metrics.Metrics).
     """
     
-    def __init__(self, host, port):
-        self.host = host
-        self.port = port
+    def __init__(self, host, port, backlog=128, handshake_workers=16, handshake_timeout=10.0, key_file=None,
+                 db_path="mails.db", db_readers=4, command_workers=16, max_pipelined=64, ticket_ttl=86400.0,
+                 ticket_key=None, max_connections=10000, idle_timeout=900.0, metrics_port=None, reuse_port=False,
+                 mail_poll_interval=None, kdf_workers=2, kdf_max_pending=None, user_cache_size=4096, shards=1):
+        self._init_common(host, port, backlog, handshake_timeout, key_file, db_path, db_readers, max_pipelined,
+                          ticket_ttl, ticket_key, max_connections, idle_timeout, kdf_workers, kdf_max_pending,
+                          user_cache_size, shards)
+        self.handshake_pool = ThreadPoolExecutor(max_workers=handshake_workers, thread_name_prefix="ycap-handshake")
+        # one slot per running handshake plus one queued per worker, then accept() backs off
+        self.handshake_slots = threading.BoundedSemaphore(handshake_workers * 2)
+        self.command_pool = ThreadPoolExecutor(max_workers=command_workers, thread_name_prefix="ycap-command")
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # allow access from multiple threads
-        self.db = sqlite3.connect("mails.db", check_same_thread=False)
+        if reuse_port:
+            self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         try:
             self.s.bind((host, port))
         except:
             ConnectionError("Port blocked or Please check firewall")
-        self.connections = {}
-        self.c = self.db.cursor()
-        # Ensure mail table exists
-        self.c.execute("""
-        CREATE TABLE IF NOT EXISTS mail (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_ TEXT,
-            to_ TEXT,
-            type_ TEXT,
-            data TEXT,
-            id INTEGER
-        )
-        """)
-        self.c.execute("""
-     CREATE TABLE IF NOT EXISTS "users" (
-	        "username"	TEXT,
-	        "password"	TEXT NOT NULL,
-	        PRIMARY KEY("username")
-)
-        """)
-        self.db.commit()
+        if port == 0:
+            # an ephemeral port was asked for; report the one the OS picked
+            self.port = self.s.getsockname()[1]
+        threading.Thread(target=self._reap_loop, daemon=True, name="ycap-reaper").start()
+        self.start_metrics(metrics_port)
+        self.start_mail_feed(mail_poll_interval)
+
+    def _init_common(self, host, port, backlog, handshake_timeout, key_file, db_path, db_readers, max_pipelined,
+                     ticket_ttl, ticket_key, max_connections, idle_timeout, kdf_workers, kdf_max_pending,
+                     user_cache_size, shards):
+        """Set up what both engines share: keys, storage, password hashing, sessions and subscribers."""
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.max_pipelined = max_pipelined
+        self.metrics = Metrics()
+        self.handshake_counters = HandshakeCounters(self.metrics)
+        self.db_path = db_path
+        self.fernet_YCAP = fernet.Fernet(load_ycap_key(key_file))
+        # tickets are sealed with a server-only key: every client knows the YCAP key
+        self.ticket_fernet = fernet.Fernet(ticket_key or fernet.Fernet.generate_key())
+        self.ticket_ttl = ticket_ttl
+        self.store = open_store(db_path, shards, readers=db_readers, metrics=self.metrics)
+        self.passwords = PasswordHasher(kdf_workers, kdf_max_pending, metrics=self.metrics)
+        self.users = UserDirectory(self.store, max_credentials=user_cache_size)
+        self.connections = ConnectionManager(max_connections, idle_timeout)
+        # mail address -> {connection key: Session} of sessions that sent SUB
+        self.subscribers = {}
+        self.subscribers_lock = threading.Lock()
+        # set once the server accepts connections
+        self.ready = threading.Event()
         self.running = True
-        self.client_threads = []
+
+    def start_metrics(self, metrics_port):
+        """Register the live gauges and, if ``metrics_port`` is set, serve the metrics on loopback."""
+        self.metrics.gauge("active_sessions", lambda: len(self.connections))
+        self.metrics.gauge("subscribed_accounts", lambda: len(self.subscribers))
+        self.metrics.gauge("user_cache_hits", lambda: self.users.hits)
+        self.metrics.gauge("user_cache_misses", lambda: self.users.misses)
+        for name in ("accepted", "in_flight", *HandshakeCounters.OUTCOMES):
+            self.metrics.gauge(f"handshakes_{name}", lambda name=name: self.handshake_counters.snapshot()[name])
+        self.metrics_server = serve_metrics(self.metrics, metrics_port) if metrics_port else None
+
+    def start_mail_feed(self, mail_poll_interval):
+        """Start polling the database for new mail if ``mail_poll_interval`` is set."""
+        self.mail_poll_interval = mail_poll_interval
+        if mail_poll_interval is not None:
+            threading.Thread(target=self._mail_feed_loop, daemon=True, name="ycap-mail-feed").start()
+
+    def _mail_feed_loop(self):
+        # mail is only inserted by writers holding SQLite's one write lock, and seq is
+        # AUTOINCREMENT (never reused after a delete), so seq grows in commit order and
+        # nothing committed later can land at or below the high-water mark
+        last_seq = self.store.last_seq()
+        while self.running:
+            time.sleep(self.mail_poll_interval)
+            if not self.subscribers:
+                # nobody to tell; skip what arrived meanwhile instead of pushing it late
+                last_seq = self.store.last_seq()
+                continue
+            try:
+                headers, last_seq = self.store.mails_after(last_seq)
+            except sqlite3.Error:
+                continue
+            if headers:
+                self.notify_subscribers(headers)
+
+    def new_session_cipher(self):
+        """Generate the per-connection Fernet key.
+
+        Returns:
+            tuple: (key wrapped with the YCAP key for the client, Fernet cipher for the session)
+        """
+        super_secret_key = fernet.Fernet.generate_key()
+        return self.fernet_YCAP.encrypt(super_secret_key), fernet.Fernet(super_secret_key)
     
-    def login(self, connection, email):
-        credentials = json.loads(connection.recv(1024)).get("credentials")
-        password = self.fernet_for_AGkey.decrypt(credentials).decode()
+    def negotiate(self, session, hello):
+        """Apply the protocol options a client asked for in its login packet.
+
+        Args:
+            session (Session): Freshly verified session
+            hello (dict): Login packet holding ``credentials`` and optional offers such as ``codecs``
+
+        Returns:
+            dict: Agreed options to send back with the verification; empty for clients that offered none
+        """
+        options = {}
+        if "codecs" in hello:
+            session.codec = choose_codec(hello.get("codecs"))
+            options["codec"] = session.codec.name
+        if "compression" in hello:
+            offered = hello.get("compression") or []
+            session.compressions = tuple(name for name in offered if name in COMPRESSIONS)
+            options["compression"] = choose_compression(offered)
+        if hello.get("tickets") and session.channel.framed and session.ticket_id is None:
+            options["ticket"] = self.issue_ticket(session)
+        return options
+
+    def issue_ticket(self, session):
+        """Seal a resumption ticket for a freshly logged-in session."""
+        issued_at = time.time()
+        session.ticket_id = secrets.token_hex(8)
+        session.ticket_expires = issued_at + self.ticket_ttl
+        payload = {"id": session.ticket_id, "email": session.email, "iat": issued_at}
+        return self.ticket_fernet.encrypt(json.dumps(payload).encode()).decode()
+
+    def check_ticket(self, ticket):
+        """Open a resumption ticket.
+
+        Returns:
+            dict: Ticket payload (``id``, ``email``, ``iat``)
+            None: If the ticket is forged, expired or revoked
+        """
         try:
-            password_real = self.c.execute("SELECT password FROM users WHERE username=?", [email]).fetchall()[0][0]
-        except:
-            return False
-        if password == password_real:
-            return True
-        else:
+            payload = json.loads(self.ticket_fernet.decrypt(ticket.encode(), ttl=int(self.ticket_ttl)))
+        except (fernet.InvalidToken, AttributeError, TypeError, ValueError):
+            return None
+        if not self.store.ticket_usable(payload["email"], payload["id"], payload["iat"]):
+            return None
+        return payload
+
+    def resume_session(self, channel, hello):
+        """Open a session from a resumption ticket instead of the key exchange and password check.
+
+        Args:
+            channel: Channel of the connecting client
+            hello (dict): First packet of the client: ``resume`` plus the usual codec/compression offers
+
+        Returns:
+            tuple: (Session or None, reply packet bytes)
+        """
+        payload = self.check_ticket(hello.get("resume"))
+        if payload is None:
+            return None, json.dumps(["RESUME FAILED", "INVALID_TICKET"]).encode()
+        session = Session(secrets.token_hex(8), channel, payload["email"], None)
+        session.ticket_id = payload["id"]
+        session.ticket_expires = payload["iat"] + self.ticket_ttl
+        return session, json.dumps(["SESSION RESUMED", self.negotiate(session, hello)]).encode()
+
+    def verified_packet(self, options):
+        # legacy clients compare the whole packet, so only extend it for clients that negotiated
+        if options:
+            return json.dumps(["USER SECURELY VERIFIED", options]).encode()
+        return json.dumps(["USER SECURELY VERIFIED"]).encode()
+
+    def verify_credentials(self, email, credentials, cipher):
+        password = cipher.decrypt(credentials).decode()
+        password_real = self.users.password(email)
+        if password_real is None:
             return False
-        
+        matches, upgraded = self.passwords.check(password, password_real)
+        if upgraded is not None:
+            # legacy or outdated hash: store the current form now that the password is known
+            self.users.set_password(email, upgraded, password_real)
+        return matches
 
     def signup(self, email_username:str, password):
         if not email_username.endswith("^ycap.com"):
             email_username += "^ycap.com"
-        self.c.execute("INSERT INTO users (username, password) VALUES (?,?)", [email_username, password])
-        self.db.commit()
+        self.users.create(email_username, self.passwords.hash(password))
         del email_username
         del password
 
     def start_listening(self):
-        while True:
-            self.s.listen()
-            connection = self.s.accept()
-            print(f"Got connection from {connection[1]}")
-            email = connection[0].recv(1024).decode()
-            super_secret_key = fernet.Fernet.generate_key()
-            defaut_YCAP_key = os.popen("echo %YCAP_KEY%").read()
-            fernet_YCAP = fernet.Fernet(defaut_YCAP_key)
-            self.fernet_for_AGkey = fernet.Fernet(super_secret_key)
-            connection[0].send(fernet_YCAP.encrypt(super_secret_key))
-
-            if self.login(connection[0], email) == True:
-                connection[0].send(json.dumps(["USER SECURELY VERIFIED"]).encode())
+        self.s.listen(self.backlog)
+        self.ready.set()
+        while self.running:
+            self.handshake_slots.acquire()
+            try:
+                connection, address = self.s.accept()
+            except OSError:
+                self.handshake_slots.release()
+                break
+            self.handshake_counters.count_accept()
+            if self.connections.full():
+                # refuse before spending a handshake on a session that could not be registered
+                self.handshake_slots.release()
+                self.handshake_counters.count_handshake("rejected", 0.0)
+                connection.close()
+                continue
+            # every packet is written whole; Nagle would only hold back the handshake's small replies
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            print(f"Got connection from {address}")
+            self.handshake_pool.submit(self.handshake, connection)
+
+    def handshake(self, connection):
+        """Run the login/signup handshake for one accepted socket on a pool worker.
+
+        The whole handshake must finish within ``handshake_timeout`` seconds, however the
+        client spreads its bytes. A verified session gets its own handle_client thread straight away.
+        """
+        started = time.perf_counter()
+        outcome = "rejected"
+        deadline = time.monotonic() + self.handshake_timeout
+        connection.settimeout(self.handshake_timeout)
+        try:
+            # framed clients get a FramedChannel, legacy clients a RawChannel
+            # frames stay small until the client has proven who it is
+            channel = accept_channel(connection, MAX_HANDSHAKE_FRAME_SIZE)
+            channel.metrics = self.metrics
+            channel.deadline = deadline
+            first = channel.recv()
+            if first.startswith(b"{"):
+                # a resumption ticket instead of an email address
+                session, reply = self.resume_session(channel, json.loads(first))
+                channel.send(reply)
+                if session is not None:
+                    if self.open_session(connection, channel, session):
+                        outcome = "completed"
+                        return
+                    raise ConnectionError("Server is at max_connections")
+                # the client falls back to a full login on the same connection
+                first = channel.recv()
+            email = first.decode()
+            wrapped_key, cipher = self.new_session_cipher()
+            channel.send(wrapped_key)
+
+            hello = json.loads(channel.recv())
+            if self.verify_credentials(email, hello.get("credentials"), cipher) == True:
                 salt = secrets.token_hex(8)  
-                self.connections.update({salt:[connection[0], email]})
-                connection[0].send(str(salt).encode())
+                session = Session(salt, channel, email, cipher)
+                channel.send(self.verified_packet(self.negotiate(session, hello)))
+                if self.open_session(connection, channel, session):
+                    outcome = "completed"
             else:
-                connection[0].send(json.dumps(["404:-USER NOT FOUND"]).encode())
-                response = json.loads(connection[0].recv(1024).decode())
+                channel.send(json.dumps(["404:-USER NOT FOUND"]).encode())
+                response = json.loads(channel.recv().decode())
                 if response[0] == "SIGN UP":
-                    credentials_e = json.loads(connection[0].recv(1024))
+                    credentials_e = json.loads(channel.recv())
                     credentials = []
                     for i in credentials_e:
-                        credentials.append(self.fernet_for_AGkey.decrypt(i).decode())
+                        credentials.append(cipher.decrypt(i).decode())
                     self.signup(credentials[0],  credentials[1])
-                else:
-                    continue
-            
-            
+        except socket.timeout:
+            outcome = "timed_out"
+        except Exception:
+            outcome = "failed"
+        finally:
+            self.handshake_slots.release()
+            self.handshake_counters.count_handshake(outcome, time.perf_counter() - started)
+        if outcome != "completed":
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def open_session(self, connection, channel, session):
+        """Register a verified session, send its connection key and start its client thread.
+
+        Returns:
+            bool: False if the server is at max_connections; the caller then drops the connection
+        """
+        if not self.connections.add(session):
+            return False
+        channel.send(str(session.key).encode())
+        channel.deadline = None
+        connection.settimeout(None)
+        if channel.framed:
+            channel.max_frame_size = MAX_FRAME_SIZE
+        t = threading.Thread(target=self.handle_client, args=(channel, session), daemon=True)
+        t.start()
+        return True
+
+    def handle_packet(self, packet, connection, key, codec=JSON_CODEC):
+        with self.metrics.time_command(self.command_name(packet)):
+            if packet.get("command") in STREAM_COMMANDS:
+                self.handle_stream(packet, connection, key, codec)
+                return
+            response = self.handle_command(packet, key)
+            if response is not None:
+                with connection.send_lock:
+                    connection.send(codec.encode(self.tag_response(packet, response)))
+        if packet.get("command") == "NRIZZ":
+            connection.close()
+
+    def command_name(self, packet):
+        """Name a packet's command is timed under; unknown commands share one name."""
+        command = packet.get("command")
+        return command if command in COMMANDS else "UNKNOWN"
+
+    def run_pipelined(self, packet, connection, key, codec, slots):
+        """Run one tagged command on the command pool, next to others from the same session."""
+        try:
+            self.handle_packet(packet, connection, key, codec)
+        except Exception:
+            # a malformed command ends the session, as it does in the sequential path
+            connection.close()
+        finally:
+            slots.release()
+
+    def tag_response(self, packet, response):
+        """Echo the packet's ``request_id`` so pipelining clients can match the response to it."""
+        if "request_id" in packet:
+            response["request_id"] = packet["request_id"]
+        return response
+
+    def handle_command(self, packet, key):
+        """Run one YCAP command and build its response.
 
-    def handle_packet(self, packet, connection, key):
+        Shared by the threaded and the asyncio engines, so it never touches the socket.
+
+        Args:
+            packet (dict): Decoded YCAP packet
+            key (str): Connection key of the session sending the packet
+
+        Returns:
+            dict: Response packet to send back
+            None: If the command gets no response
+        """
         command = packet.get("command")
         arg = packet.get("arguments")
         if command == "YCAP":
@@ -134,97 +1571,152 @@ class Server:
                         "return":[
                             "OK"
                         ],}
-                data = json.dumps(data)
-                connection.send(data.encode())
+                return data
         if command == "NRIZZ":
+            # logging out ends the resumption ticket too
+            session = self.connections.get(key)
+            if session.ticket_id is not None:
+                self.store.revoke_ticket(session.ticket_id, session.ticket_expires)
             data = {
                         "connection_key":key,
                         "command":"NRIZZ",
                         "return":[
                             "GOODBYE"
                         ],}
-            data = json.dumps(data)
-            connection.send(data.encode())
-            connection.close()
+            return data
 
         if command == "NOOP":
-            if arg[0] == [self.host, self.port]:
-                data = {
-                        "connection_key":key,
-                        "command":"NOOP",
-                        "return":[
-                            "NOOP"
-                        ],}
-                data = json.dumps(data)
-                connection.send(data.encode())
-                connection.close()
+            data = {
+                    "connection_key":key,
+                    "command":"NOOP",
+                    "return":[
+                        "NOOP"
+                    ],}
+            return data
+        if command == "REVOKE":
+            # revoke every resumption ticket of the account, e.g. after a leaked device
+            self.store.revoke_tickets(self.connections.get(key).email)
+            response = {
+                "connection_key": str(key),
+                "command": "REVOKE",
+                "return": ["TICKETS_REVOKED"]
+            }
+            return response
+        if command == "SUB":
+            # push NEW_MAIL packets to this session whenever mail for its owner is stored
+            session = self.connections.get(key)
+            if not session.channel.framed:
+                result = ["SUB_NOT_SUPPORTED", "FRAMING_REQUIRED"]
+            else:
+                self.subscribe(session)
+                result = ["SUBSCRIBED"]
+            response = {
+                "connection_key": str(key),
+                "command": "SUB",
+                "return": result
+            }
+            return response
+        if command == "UNSUB":
+            self.unsubscribe(self.connections.get(key))
+            response = {
+                "connection_key": str(key),
+                "command": "UNSUB",
+                "return": ["UNSUBSCRIBED"]
+            }
+            return response
         if command == "LYAP":
-            # Arguments: [FROM, TO ] (all optional)
+            # Arguments: [sent, limit, before, headers] (all but sent optional)
             sent = arg[0]
-            info_stealer = False
-            # Build query
-            if sent:
-                to_addr = ""
-                from_addr = self.connections.get(key)[1] 
-            else:
-                from_addr = ""
-                to_addr = self.connections.get(key)[1]
-            query = "SELECT id FROM mail WHERE "
-            params = []
-            if from_addr:
-                query += " from_=?"
-                if from_addr != self.connections.get(key)[1]:
-                    info_stealer = True
-                params.append(from_addr)
-            if to_addr:
-                query += " to_=?"
-                if to_addr != self.connections.get(key)[1]:
-                    info_stealer = True
-                params.append(to_addr)
-            if not info_stealer:
-                result = self.c.execute(query, params).fetchall()
-
-                # Format response
-                emails = [
-                    r[0]
-                    for r in result
-                ]
+            limit = arg[1] if len(arg) > 1 else None
+            before = arg[2] if len(arg) > 2 else None
+            headers = arg[3] if len(arg) > 3 else False
+            # the box owner always comes from the session, never from the packet,
+            # so nobody can list other people's mail
+            column = "from_" if sent else "to_"
+            owner = self.connections.get(key).email
+            if limit is None:
                 response = {
                     "connection_key": str(key),
                     "command": "LYAP",
-                    "return": emails
+                    "return": self.store.list_ids(column, owner)
                 }
-                connection.send(json.dumps(response).encode())
-                return 
+                return response
+            emails, cursor = self.store.list_page(column, owner, limit, before, headers)
             response = {
-                    "connection_key": str(key),
-                    "command": "LYAP",
-                    "return": "NO stealing"
+                "connection_key": str(key),
+                "command": "LYAP",
+                "return": emails,
+                "cursor": cursor
+            }
+            return response
+        if command == "SEARCH":
+            # Arguments: [query, limit, before] (limit and before optional); like LYAP the
+            # owner comes from the session, so only the session's own mail is searched
+            query = arg[0]
+            limit = arg[1] if len(arg) > 1 and arg[1] is not None else 50
+            before = arg[2] if len(arg) > 2 else None
+            rows, cursor = self.store.search(self.connections.get(key).email, query, limit, before)
+            response = {
+                "connection_key": str(key),
+                "command": "SEARCH",
+                "return": rows,
+                "cursor": cursor
             }
-            connection.send(json.dumps(response).encode())
+            return response
         if command == "GMA": 
             mail_id = arg[0]
-            query = "SELECT id, from_, to_, type_, data FROM mail WHERE id=?"
-            result = self.c.execute(query, [mail_id]).fetchall()
+            result = self.mails_for(key, self.store.get_mails([mail_id]))
             response = {
                     "connection_key": str(key),
                     "command": "GMA",
                     "return": result
             }
-            connection.send(json.dumps(response).encode())
-            return
+            return response
+        if command == "MGMA":
+            # Arguments: [[mail_id, ...]] -> rows in the order the ids were asked for
+            rows = self.mails_for(key, self.store.get_mails(arg[0]))
+            response = {
+                    "connection_key": str(key),
+                    "command": "MGMA",
+                    "return": rows
+            }
+            return response
         if command == "YAP":
-            # Expecting arguments: [[from, to], type, data]
+            # Expecting arguments: [[from, to], type, data, encoding]; to may be a list of
+            # recipients and encoding names the compression of data (omitted for plain bodies)
             from_ = arg[0][0]
             to_ = arg[0][1]
             mail_type = arg[1]
-            mail_data =arg[2]
-            mail_id = secrets.token_hex(8)
-            if self.c.execute("SELECT username FROM users WHERE username=?", [to_]).fetchall() != []:
-                # Insert mail into database
-                self.c.execute("INSERT INTO mail (from_, to_, type_, data, id) VALUES (?, ?, ?, ?, ?)", (from_, to_, mail_type, mail_data, mail_id))
-              # Get the ID of the newly inserted mail
-                self.db.commit()
+            encoding = arg[3] if len(arg) > 3 else None
+            if encoding is not None and encoding not in COMPRESSIONS:
+                response = {
+                    "connection_key": str(key),
+                    "command": "YAP",
+                    "return": ["MAIL_NOT_SENT", "UNKNOWN_COMPRESSION"]
+                }
+                return response
+            if encoding is None:
+                mail_data, encoding = compress_body(arg[2], STORE_COMPRESSION)
+                # the store indexes the stored form, the same text delete_mail unindexes
+                text = None
+            else:
+                # already compressed by the client; stored as it came once it unpacks cleanly
+                try:
+                    mail_data = body_from_wire(arg[2])
+                    text = search_text(COMPRESSIONS[encoding].decompress(mail_data), None)
+                except ValueError:
+                    response = {
+                        "connection_key": str(key),
+                        "command": "YAP",
+                        "return": ["MAIL_NOT_SENT", "BAD_COMPRESSION"]
+                    }
+                    return response
+            if isinstance(to_, list):
+                return self.bulk_yap(key, from_, to_, mail_type, mail_data, encoding, text)
+            if self.users.exists(to_):
+                # Insert mail into database; returns once its group commit is durable
+                mail_id = self.store.insert_mail(from_, to_, mail_type, mail_data, encoding, text)
+                self.publish_new_mail([[mail_id, from_, to_, mail_type]])
                 # Send response to client with the new mail ID
                 response = {
                     "connection_key": str(key),
@@ -238,79 +1730,332 @@ class Server:
                 "return": ["MAIL_NOT_SENT", "TO_USER_NOT_EXIST"]
             }
 
-            connection.send(json.dumps(response).encode())
+            return response
         if command == "NYAP":
             id = arg[0]
-            if not self.c.execute('SELECT * FROM mail WHERE id = ?', [id]).fetchall() == []:
-                self.c.execute("DELETE FROM mail WHERE id = ?", [id])
+            if self.store.delete_mail(id):
                 response = {
                     "connection_key": str(key),
                     "command": "NYAP",
                     "return": ["MAIL_DELETED", id]
                 }
-                connection.send(json.dumps(response).encode())
+                return response
             else:
                 response = {
                 "connection_key": str(key),
                 "command": "NYAP",
                 "return": ["MAIL_NOT_DELETED", "MAIL_OR_MAIL_ID_DOESNT_EXIST"]
                 }
-                connection.send(json.dumps(response).encode())
+                return response
+        return None
             
 
-    def handle_client(self, ):
-        # handle the most recent connection (caller adds new connections)
-        connection = list(self.connections.values())[-1][0]
-        while self.running:
+    def mails_for(self, key, rows):
+        """Shape stored mail rows for the session asking for them.
+
+        Sessions that negotiated compression get ``[id, from, to, type, data, encoding]`` and
+        receive bodies still packed in a compression they accept. Every other body is unpacked
+        here and travels as text, in the original ``[id, from, to, type, data]`` rows.
+        """
+        session = self.connections.get(key)
+        accepted = session.compressions if session is not None else None
+        mails = []
+        for mail_id, from_, to_, mail_type, data, encoding in rows:
+            if encoding is not None and accepted is not None and encoding in accepted:
+                mails.append([mail_id, from_, to_, mail_type, body_to_wire(data, session.codec), encoding])
+                continue
+            row = [mail_id, from_, to_, mail_type, decompress_body(data, encoding)]
+            if accepted is not None:
+                row.append(None)
+            mails.append(row)
+        return mails
+
+    def bulk_yap(self, key, from_, recipients, mail_type, mail_data, encoding=None, text=None):
+        """Send one mail to many recipients: one lookup query, one insert transaction.
+
+        Returns:
+            dict: YAP response whose return is ``["MAIL_SENT", {to: mail_id}, {to: reason}]``, or
+            ``["MAIL_NOT_SENT", "TO_USER_NOT_EXIST", {to: reason}]`` when no recipient exists
+        """
+        recipients = list(dict.fromkeys(recipients))
+        existing = self.users.existing(recipients)
+        failed = {to_: "TO_USER_NOT_EXIST" for to_ in recipients if to_ not in existing}
+        valid = [to_ for to_ in recipients if to_ in existing]
+        if not valid:
+            result = ["MAIL_NOT_SENT", "TO_USER_NOT_EXIST", failed]
+        else:
+            mail_ids = self.store.insert_mails(from_, valid, mail_type, mail_data, encoding, text)
+            self.publish_new_mail([[mail_id, from_, to_, mail_type] for to_, mail_id in mail_ids.items()])
+            result = ["MAIL_SENT", mail_ids, failed]
+        response = {
+            "connection_key": str(key),
+            "command": "YAP",
+            "return": result
+        }
+        return response
+
+    def handle_stream(self, packet, connection, key, codec):
+        """Run SGMA (stream a body out) or SYAP (stream a body in) on a framed connection.
+
+        Body chunks travel as raw frames of up to STREAM_CHUNK_SIZE bytes after the
+        command packet, and an empty frame ends the body.
+        """
+        command = packet.get("command")
+        if not connection.framed:
+            with connection.send_lock:
+                connection.send(codec.encode(self.tag_response(packet, self.stream_unsupported(key, command))))
+            return
+        if command == "SGMA":
+            response, seq, size, body = self.stream_header(key, packet.get("arguments")[0])
+            # hold the channel for the whole body so no push lands between its frames
+            with connection.send_lock:
+                connection.send(codec.encode(self.tag_response(packet, response)))
+                if seq is None:
+                    return
+                for offset in range(0, size, STREAM_CHUNK_SIZE):
+                    if body is not None:
+                        connection.send(body[offset:offset + STREAM_CHUNK_SIZE])
+                    else:
+                        connection.send(self.store.read_body_chunk(seq, offset, STREAM_CHUNK_SIZE))
+                connection.send(b"")
+            return
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT) as spool:
+            received = 0
+            chunk = connection.recv()
+            while chunk:
+                received += len(chunk)
+                spool.write(chunk)
+                chunk = connection.recv()
+            if chunk is None:
+                raise ConnectionError("Client closed the connection in the middle of SYAP")
+            response = self.stream_upload(key, packet.get("arguments"), spool, received)
+            with connection.send_lock:
+                connection.send(codec.encode(self.tag_response(packet, response)))
+
+    def stream_unsupported(self, key, command):
+        response = {
+            "connection_key": str(key),
+            "command": command,
+            "return": ["STREAM_NOT_SUPPORTED", "FRAMING_REQUIRED"]
+        }
+        return response
+
+    def stream_header(self, key, mail_id):
+        """Build the SGMA header packet.
+
+        Bodies are streamed as stored. A compressed body goes out packed to sessions that
+        accept its compression, with the compression as a sixth header field; for every other
+        session it is unpacked in memory first (compressed bodies came in through YAP, so they
+        fit in one packet anyway).
+
+        Returns:
+            tuple: (response whose return is ``[id, from, to, type, size]`` or ``[]``, seq or None,
+            size, unpacked body or None when the body streams straight from the database)
+        """
+        found = self.store.mail_header(mail_id)
+        response = {
+            "connection_key": str(key),
+            "command": "SGMA",
+            "return": []
+        }
+        if found is None:
+            return response, None, 0, None
+        header, seq, encoding = found
+        session = self.connections.get(key)
+        accepted = session.compressions if session is not None else None
+        body = None
+        if encoding is not None and (accepted is None or encoding not in accepted):
+            body = COMPRESSIONS[encoding].decompress(self.store.read_body_chunk(seq, 0, header[4]))
+            header[4] = len(body)
+            encoding = None
+        if accepted is not None:
+            header.append(encoding)
+        response["return"] = header
+        return response, seq, header[4], body
+
+    def stream_upload(self, key, arguments, spool, received):
+        """Store a spooled SYAP body and build the YAP-style response."""
+        # Expecting arguments: [[from, to], type, size]
+        from_, to_ = arguments[0]
+        mail_type = arguments[1]
+        size = arguments[2]
+        if received != size:
+            result = ["MAIL_NOT_SENT", "SIZE_MISMATCH"]
+        elif not self.users.exists(to_):
+            result = ["MAIL_NOT_SENT", "TO_USER_NOT_EXIST"]
+        else:
+            mail_id = self.store.insert_mail_stream(from_, to_, mail_type, spool, size)
+            self.publish_new_mail([[mail_id, from_, to_, mail_type]])
+            result = ["MAIL_SENT", mail_id]
+        response = {
+            "connection_key": str(key),
+            "command": "SYAP",
+            "return": result
+        }
+        return response
+
+    def subscribe(self, session):
+        with self.subscribers_lock:
+            self.subscribers.setdefault(session.email, {})[session.key] = session
+
+    def unsubscribe(self, session):
+        with self.subscribers_lock:
+            sessions = self.subscribers.get(session.email)
+            if sessions is not None:
+                sessions.pop(session.key, None)
+                if not sessions:
+                    del self.subscribers[session.email]
+            if session.pushes is not None:
+                # ends the session's push thread once it has sent what is already queued
+                session.pushes.put(None)
+                session.pushes = None
+
+    def publish_new_mail(self, mails):
+        """Tell subscribers about mails this process has just committed.
+
+        With a mail feed running the feed finds them in the database instead, along with
+        mail committed by the other server processes, so nothing is pushed twice.
+
+        Args:
+            mails (list): ``[id, from, to, type]`` headers of the stored mails
+        """
+        if self.mail_poll_interval is None:
+            self.notify_subscribers(mails)
+
+    def notify_subscribers(self, mails):
+        """Push a NEW_MAIL packet to every subscribed session of each recipient.
+
+        Pushes are only queued here, so a slow subscriber never holds up the YAP that
+        triggered them.
+
+        Args:
+            mails (list): ``[id, from, to, type]`` headers of committed mails
+        """
+        if not self.subscribers:
+            return
+        for header in mails:
+            with self.subscribers_lock:
+                sessions = list(self.subscribers.get(header[2], {}).values())
+            for session in sessions:
+                packet = {
+                    "connection_key": str(session.key),
+                    "command": PUSH_COMMAND,
+                    "return": header
+                }
+                self.push(session, packet)
+
+    def push(self, session, packet):
+        """Queue a push for the session's own push thread, started with its first push."""
+        with self.subscribers_lock:
+            pushes = session.pushes
+            if pushes is None:
+                pushes = session.pushes = queue.SimpleQueue()
+                threading.Thread(target=self._push_loop, args=(session, pushes), daemon=True,
+                                 name="ycap-push").start()
+        if pushes.qsize() >= MAX_QUEUED_PUSHES:
+            # the subscriber stopped reading; drop it instead of queueing for it without end
+            print(f"Closing session {session.key}: {MAX_QUEUED_PUSHES} pushes unsent")
+            self.unsubscribe(session)
+            session.channel.close()
+            return
+        pushes.put(packet)
+
+    def _push_loop(self, session, pushes):
+        """Send one subscriber's pushes in order; a subscriber that stops reading stalls only this thread."""
+        while True:
+            packet = pushes.get()
+            if packet is None:
+                return
             try:
-                data = connection.recv(10500000)
-                if not data:
-                    break
-                packet = data.decode()
+                with session.channel.send_lock:
+                    session.channel.send(session.codec.encode(packet))
             except Exception:
-                break
-            if not packet == "":
-                try:
-                    packet = json.loads(packet)
-                except Exception:
-                    continue
+                # the subscriber is gone; its own thread cleans up the session
+                self.unsubscribe(session)
+                return
+
+    def handle_client(self, connection, session):
+        in_flight = []
+        slots = threading.BoundedSemaphore(self.max_pipelined)
+        try:
+            while self.running:
                 try:
-                    key = packet.get("connection_key")
+                    # a framed channel hands back exactly one packet per call, even when
+                    # several pipelined packets arrived in one read
+                    data = connection.recv()
+                    if not data:
+                        break
                 except Exception:
-                    key = None
-                if key is None or self.connections.get(key) is None:
-                    print("Invalid key found! Removing Connection")
-                    # try to remove mapping for this connection
+                    break
+                if data:
                     try:
-                        to_remove = None
-                        for k, v in list(self.connections.items()):
-                            if v == connection:
-                                to_remove = k
-                                break
-                        if to_remove is not None:
-                            self.connections.pop(to_remove)
+                        packet = session.codec.decode(data)
                     except Exception:
-                        pass
+                        continue
                     try:
-                        connection.close()
+                        key = packet.get("connection_key")
                     except Exception:
-                        pass
-                    break
-                self.handle_packet(packet, connection, key)
+                        key = None
+                    # the key must be this connection's own, not just any live session's
+                    if key is None or self.connections.get(key) is not session:
+                        print("Invalid key found! Removing Connection")
+                        try:
+                            connection.close()
+                        except Exception:
+                            pass
+                        break
+                    session.touch()
+                    command = packet.get("command")
+                    if "request_id" in packet and command not in STREAM_COMMANDS and command != "NRIZZ":
+                        # tagged requests may complete out of order, so run them side by side;
+                        # waiting for a slot stops reading from a client that pipelines too far ahead
+                        slots.acquire()
+                        in_flight = [future for future in in_flight if not future.done()]
+                        in_flight.append(self.command_pool.submit(self.run_pipelined, packet, connection, key,
+                                                                  session.codec, slots))
+                        continue
+                    # untagged clients expect responses in order, and NRIZZ/streams wait for what runs
+                    if in_flight:
+                        wait(in_flight)
+                        in_flight = []
+                    try:
+                        self.handle_packet(packet, connection, key, session.codec)
+                    except Exception:
+                        # a malformed command (missing arguments, wrong types) ends the session
+                        break
+        finally:
+            self.connections.remove(session)
+            self.unsubscribe(session)
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def reap_interval(self):
+        return max(1.0, min(self.connections.idle_timeout / 4, 30.0))
+
+    def _reap_loop(self):
+        while self.running:
+            time.sleep(self.reap_interval())
+            for session in self.connections.idle_sessions():
+                print(f"Closing idle session {session.key}")
+                self.connections.remove(session)
+                self.unsubscribe(session)
+                try:
+                    # wakes the session's handle_client thread out of recv()
+                    session.channel.close()
+                except Exception:
+                    pass
+
     def ycap_run(self):
         connect_thread = threading.Thread(target=self.start_listening, daemon=True)
         connect_thread.start()
         # start Ctrl+B listener (Windows)
         if msvcrt is not None:
             threading.Thread(target=self._ctrl_b_listener, daemon=True).start()
-        current_connections = len(self.connections)
         try:
+            # handshake workers start client threads themselves; just keep the main thread alive
             while self.running:
-                if len(self.connections) > current_connections:
-                    t = threading.Thread(target=self.handle_client, daemon=True)
-                    t.start()
-                    self.client_threads.append(t)
-                    current_connections = len(self.connections)
                 time.sleep(0.2)
         except KeyboardInterrupt:
             print("KeyboardInterrupt received. Shutting down.")
@@ -339,19 +2084,21 @@ class Server:
                 self.s.close()
             except Exception:
                 pass
-            for k, conn in list(self.connections.items()):
+            try:
+                self.handshake_pool.shutdown(wait=False, cancel_futures=True)
+                self.command_pool.shutdown(wait=False, cancel_futures=True)
+            except Exception:
+                pass
+            for session in self.connections.sessions():
                 try:
-                    conn.close()
+                    session.channel.close()
                 except Exception:
                     pass
-            for t in self.client_threads:
-                if t.is_alive():
-                    t.join(timeout=0.2)
             try:
-                self.db.commit()
-                self.db.close()
+                self.store.close()
             except Exception:
                 pass
+            self.passwords.close()
         finally:
             print("Server stopped.")
             try:
@@ -361,5 +2108,358 @@ class Server:
 
 
 
-ycap = Server("localhost", 1200)
-ycap.ycap_run()
\ No newline at end of file
+
+class AsyncServer(Server):
+    """asyncio YCAP server engine.
+
+    Serves the same command set as Server (YCAP, NOOP, NRIZZ, LYAP, GMA, YAP, NYAP) from one
+    event loop instead of one OS thread per client, so idle sessions only cost a coroutine.
+    MailStore calls run on an executor so they never block the loop; several of them in
+    flight let concurrent reads use the reader pool and concurrent YAPs share a group commit.
+    Packets carrying a ``request_id`` run side by side, up to ``max_pipelined`` per session,
+    and are answered as they finish. Only framed clients are accepted.
+    """
+
+    def __init__(self, host, port, backlog=1024, handshake_timeout=10.0, key_file=None, db_path="mails.db",
+                 db_readers=4, db_workers=16, max_pipelined=64, ticket_ttl=86400.0, ticket_key=None,
+                 max_connections=10000, idle_timeout=900.0, metrics_port=None, reuse_port=False,
+                 mail_poll_interval=None, kdf_workers=2, kdf_max_pending=None, user_cache_size=4096, shards=1):
+        self._init_common(host, port, backlog, handshake_timeout, key_file, db_path, db_readers, max_pipelined,
+                          ticket_ttl, ticket_key, max_connections, idle_timeout, kdf_workers, kdf_max_pending,
+                          user_cache_size, shards)
+        self.reuse_port = reuse_port
+        self.loop = None
+        self.db_executor = ThreadPoolExecutor(max_workers=db_workers, thread_name_prefix="ycap-db")
+        self.start_metrics(metrics_port)
+        self.start_mail_feed(mail_poll_interval)
+
+    async def run_db(self, func, *args):
+        """Run a blocking MailStore call on the database executor."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, func, *args)
+
+    async def verify_credentials_async(self, email, credentials, cipher):
+        """Async twin of Server.verify_credentials; the KDF runs on the password pool, not a DB thread."""
+        password = cipher.decrypt(credentials).decode()
+        password_real = await self.run_db(self.users.password, email)
+        if password_real is None:
+            return False
+        matches, upgraded = await self.passwords.run_async(check_password, password, password_real)
+        if upgraded is not None:
+            await self.run_db(self.users.set_password, email, upgraded, password_real)
+        return matches
+
+    async def signup_async(self, email_username, password):
+        """Async twin of Server.signup."""
+        if not email_username.endswith("^ycap.com"):
+            email_username += "^ycap.com"
+        password_hash = await self.passwords.run_async(hash_password, password)
+        await self.run_db(self.users.create, email_username, password_hash)
+
+    async def handshake(self, channel):
+        """Async twin of Server.handshake.
+
+        Returns:
+            Session: The verified session
+            None: If the client failed to log in (signup requests are handled here too)
+        """
+        first = await channel.recv()
+        if first.startswith(b"{"):
+            session, reply = await self.run_db(self.resume_session, channel, json.loads(first))
+            await channel.send(reply)
+            if session is not None:
+                if not self.connections.add(session):
+                    return None
+                await channel.send(str(session.key).encode())
+                return session
+            first = await channel.recv()
+        email = first.decode()
+        wrapped_key, cipher = self.new_session_cipher()
+        await channel.send(wrapped_key)
+        hello = json.loads(await channel.recv())
+        if await self.verify_credentials_async(email, hello.get("credentials"), cipher):
+            salt = secrets.token_hex(8)
+            session = Session(salt, channel, email, cipher)
+            await channel.send(self.verified_packet(self.negotiate(session, hello)))
+            if not self.connections.add(session):
+                return None
+            await channel.send(str(salt).encode())
+            return session
+        await channel.send(json.dumps(["404:-USER NOT FOUND"]).encode())
+        response = json.loads((await channel.recv()).decode())
+        if response[0] == "SIGN UP":
+            credentials_e = json.loads(await channel.recv())
+            credentials = []
+            for i in credentials_e:
+                credentials.append(cipher.decrypt(i).decode())
+            await self.signup_async(credentials[0], credentials[1])
+        return None
+
+    async def handle_connection(self, reader, writer):
+        print(f"Got connection from {writer.get_extra_info('peername')}")
+        self.handshake_counters.count_accept()
+        # frames stay small until the client has proven who it is
+        channel = AsyncFramedChannel(reader, writer, MAX_HANDSHAKE_FRAME_SIZE)
+        channel.metrics = self.metrics
+        if self.connections.full():
+            self.handshake_counters.count_handshake("rejected", 0.0)
+            channel.close()
+            return
+        session = None
+        started = time.perf_counter()
+        outcome = "failed"
+        try:
+            try:
+                session = await asyncio.wait_for(self.handshake(channel), self.handshake_timeout)
+                outcome = "completed" if session is not None else "rejected"
+                if session is not None:
+                    channel.max_frame_size = MAX_FRAME_SIZE
+            except asyncio.TimeoutError:
+                outcome = "timed_out"
+            finally:
+                self.handshake_counters.count_handshake(outcome, time.perf_counter() - started)
+            in_flight = set()
+            slots = asyncio.Semaphore(self.max_pipelined)
+            while session is not None and self.running:
+                data = await channel.recv()
+                if not data:
+                    break
+                try:
+                    packet = session.codec.decode(data)
+                except Exception:
+                    continue
+                if self.connections.get(packet.get("connection_key")) is not session:
+                    print("Invalid key found! Removing Connection")
+                    break
+                session.touch()
+                command = packet.get("command")
+                if "request_id" in packet and command not in STREAM_COMMANDS and command != "NRIZZ":
+                    # tagged requests may complete out of order, so run them side by side;
+                    # waiting for a slot stops reading from a client that pipelines too far ahead
+                    await slots.acquire()
+                    task = asyncio.create_task(self.run_pipelined(packet, session, slots))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    continue
+                # untagged clients expect responses in order, and NRIZZ/streams wait for what runs
+                if in_flight:
+                    await asyncio.gather(*in_flight)
+                with self.metrics.time_command(self.command_name(packet)):
+                    if command in STREAM_COMMANDS:
+                        await self.handle_stream_async(packet, channel, packet.get("connection_key"), session.codec)
+                        continue
+                    response = await self.run_db(self.handle_command, packet, packet.get("connection_key"))
+                    if response is not None:
+                        async with channel.send_lock:
+                            await channel.send(session.codec.encode(self.tag_response(packet, response)))
+                if command == "NRIZZ":
+                    break
+        except (ProtocolError, ConnectionError, asyncio.IncompleteReadError, fernet.InvalidToken, ValueError, TypeError,
+                LookupError, AttributeError, sqlite3.Error):
+            # a malformed packet (not a dict, missing or mistyped arguments) or a refused write such
+            # as a duplicate signup ends the session quietly, as in the threaded engine
+            pass
+        finally:
+            if session is not None:
+                self.connections.remove(session)
+                self.unsubscribe(session)
+            channel.close()
+
+    async def run_pipelined(self, packet, session, slots):
+        """Run one tagged command next to others from the same session."""
+        try:
+            with self.metrics.time_command(self.command_name(packet)):
+                response = await self.run_db(self.handle_command, packet, packet.get("connection_key"))
+                if response is not None:
+                    async with session.channel.send_lock:
+                        await session.channel.send(session.codec.encode(self.tag_response(packet, response)))
+        except Exception:
+            # a malformed command ends the session, as it does in the sequential path
+            session.channel.close()
+        finally:
+            slots.release()
+
+    async def handle_stream_async(self, packet, channel, key, codec):
+        """Async twin of Server.handle_stream; blob I/O runs on the database executor."""
+        if packet.get("command") == "SGMA":
+            response, seq, size, body = await self.run_db(self.stream_header, key, packet.get("arguments")[0])
+            async with channel.send_lock:
+                await channel.send(codec.encode(self.tag_response(packet, response)))
+                if seq is None:
+                    return
+                for offset in range(0, size, STREAM_CHUNK_SIZE):
+                    if body is not None:
+                        await channel.send(body[offset:offset + STREAM_CHUNK_SIZE])
+                    else:
+                        await channel.send(await self.run_db(self.store.read_body_chunk, seq, offset, STREAM_CHUNK_SIZE))
+                await channel.send(b"")
+            return
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_MEMORY_LIMIT) as spool:
+            received = 0
+            chunk = await channel.recv()
+            while chunk:
+                received += len(chunk)
+                await self.run_db(spool.write, chunk)
+                chunk = await channel.recv()
+            if chunk is None:
+                raise ConnectionError("Client closed the connection in the middle of SYAP")
+            response = await self.run_db(self.stream_upload, key, packet.get("arguments"), spool, received)
+            async with channel.send_lock:
+                await channel.send(codec.encode(self.tag_response(packet, response)))
+
+    def push(self, session, packet):
+        # publish_new_mail runs on a database executor thread; hand the send to the loop
+        asyncio.run_coroutine_threadsafe(self.push_async(session, packet), self.loop)
+
+    async def push_async(self, session, packet):
+        if session.pending_pushes >= MAX_QUEUED_PUSHES:
+            # the subscriber stopped reading; abort, as a plain close would wait for its buffer to drain
+            print(f"Closing session {session.key}: {MAX_QUEUED_PUSHES} pushes unsent")
+            self.unsubscribe(session)
+            session.channel.writer.transport.abort()
+            return
+        session.pending_pushes += 1
+        try:
+            async with session.channel.send_lock:
+                await session.channel.send(session.codec.encode(packet))
+        except Exception:
+            self.unsubscribe(session)
+        finally:
+            session.pending_pushes -= 1
+
+    async def reap_idle(self):
+        while self.running:
+            await asyncio.sleep(self.reap_interval())
+            for session in self.connections.idle_sessions():
+                print(f"Closing idle session {session.key}")
+                # handle_connection sees EOF and cleans the session up
+                session.channel.close()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        reaper = asyncio.create_task(self.reap_idle())
+        server = await asyncio.start_server(self.handle_connection, self.host, self.port, backlog=self.backlog,
+                                            reuse_port=self.reuse_port or None)
+        if self.port == 0:
+            self.port = server.sockets[0].getsockname()[1]
+        self.ready.set()
+        async with server:
+            await server.serve_forever()
+
+    def ycap_run(self):
+        if msvcrt is not None:
+            threading.Thread(target=self._ctrl_b_listener, daemon=True).start()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            print("KeyboardInterrupt received. Shutting down.")
+            self.shutdown()
+
+
+def _serve_worker(engine, host, port, options):
+    engine_class = AsyncServer if engine == "async" else Server
+    engine_class(host, port, reuse_port=True, **options).ycap_run()
+
+
+def run_workers(workers, host, port, engine="threaded", db_path="mails.db", metrics_port=None,
+                mail_poll_interval=0.25, **options):
+    """Serve ``host:port`` from several server processes so every core does work.
+
+    Each worker binds the port with SO_REUSEPORT and the kernel spreads new connections over
+    them. A connection stays in the worker that accepted it, so its session state never moves.
+    The workers share the SQLite database in WAL mode and one ticket key, so a ticket issued
+    by one worker resumes on any other. Mail for push subscribers is found by polling the
+    database every ``mail_poll_interval`` seconds, whichever worker stored it. A worker that
+    crashes is restarted. Limits such as ``max_connections`` apply per worker.
+
+    Args:
+        workers (int): Number of server processes
+        host (str): Address to listen on
+        port (int): Port to listen on; must be fixed, every worker binds the same one
+        engine (str): ``threaded`` or ``async``
+        db_path (str): SQLite database file, upgraded once here before the workers start
+        metrics_port (int, optional): Worker ``n`` serves its metrics on ``metrics_port + n``
+        mail_poll_interval (float): Seconds between the polls that find new mail for subscribers
+        **options: Further Server/AsyncServer arguments, passed to every worker
+    """
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise RuntimeError("Several workers need SO_REUSEPORT, which this platform does not have")
+    if not port:
+        raise ValueError("Workers must share a fixed port")
+    with closing(sqlite3.connect(db_path)) as db:
+        # migrate once, before several processes could race to do it
+        db.execute("PRAGMA journal_mode=WAL")
+        migrate_schema(db)
+    if options.get("shards", 1) > 1:
+        # the same for the shard files
+        open_store(db_path, options["shards"], readers=1).close()
+    options["db_path"] = db_path
+    options["mail_poll_interval"] = mail_poll_interval
+    options["ticket_key"] = options.get("ticket_key") or fernet.Fernet.generate_key()
+    context = multiprocessing.get_context("spawn")
+
+    def start(index):
+        worker_options = dict(options, metrics_port=metrics_port + index if metrics_port else None)
+        process = context.Process(target=_serve_worker, args=(engine, host, port, worker_options),
+                                  name=f"ycap-worker-{index}")
+        process.start()
+        return process
+
+    processes = [start(index) for index in range(workers)]
+    # a service manager stops the server with SIGTERM; take the workers down with it
+    signal.signal(signal.SIGTERM, _stop_workers)
+    try:
+        while any(process.is_alive() for process in processes):
+            time.sleep(1.0)
+            for index, process in enumerate(processes):
+                if process.exitcode not in (None, 0):
+                    print(f"Worker {index} exited with code {process.exitcode}; restarting it")
+                    processes[index] = start(index)
+    except KeyboardInterrupt:
+        print("Shutting down workers...")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(5)
+
+
+def _stop_workers(signum, frame):
+    raise KeyboardInterrupt
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the YCAP mail server")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1200)
+    parser.add_argument("--engine", choices=["threaded", "async"], default="threaded",
+                        help="threaded: one thread per client, async: single asyncio event loop")
+    parser.add_argument("--key-file", default=None, help="file holding the YCAP master key (default: $YCAP_KEY)")
+    parser.add_argument("--db", default="mails.db", help="SQLite database file (upgraded in place on start)")
+    parser.add_argument("--max-connections", type=int, default=10000, help="most logged-in sessions at once")
+    parser.add_argument("--idle-timeout", type=float, default=900.0,
+                        help="seconds a session may stay silent before it is closed")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve metrics as text on http://127.0.0.1:<port>/ (off by default)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="server processes sharing the port through SO_REUSEPORT (default 1)")
+    parser.add_argument("--kdf-workers", type=int, default=2,
+                        help="processes hashing and checking passwords, per server process (default 2)")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="spread mail over this many SQLite files next to --db (default 1: all in --db)")
+    parser.add_argument("--rebalance", action="store_true",
+                        help="move the mail in --db into --shards shard files, then exit; stop the server first")
+    args = parser.parse_args()
+    if args.rebalance:
+        for index, count in enumerate(rebalance_shards(args.db, args.shards)):
+            print(f"{shard_path(args.db, index)}: {count} mails")
+        raise SystemExit(0)
+    settings = {"max_connections": args.max_connections, "idle_timeout": args.idle_timeout,
+                "metrics_port": args.metrics_port, "kdf_workers": args.kdf_workers, "shards": args.shards}
+    if args.workers > 1:
+        run_workers(args.workers, args.host, args.port, engine=args.engine, key_file=args.key_file,
+                    db_path=args.db, **settings)
+    else:
+        engine_class = AsyncServer if args.engine == "async" else Server
+        ycap = engine_class(args.host, args.port, key_file=args.key_file, db_path=args.db, **settings)
+        ycap.ycap_run()
@@ -0,0 +1,181 @@
+import bisect
+import http.server
+import threading
+import time
+from contextlib import contextmanager
+
+"""
+YCAP Metrics
+
+Counters and latency histograms shared by the server and the client. Recording is cheap
+(one lock, a few additions) so it stays on in the hot path. A snapshot comes out as a dict,
+or as Prometheus-style text for the local stats endpoint.
+"""
+
+# upper bounds in seconds of the latency histogram buckets; slower samples land in +Inf
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """Fixed-bucket latency histogram; not thread-safe on its own, Metrics guards it."""
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile (the max for the +Inf bucket)."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.total,
+            "avg": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+
+class Metrics:
+    """Thread-safe registry of per-command latency, named timings, byte counts and gauges.
+
+    Commands get a count, an error count and a latency histogram each. Timings are other
+    named histograms (handshakes, database reads and commits). Gauges are callables read at
+    snapshot time, so live values such as the session count cost nothing until asked for.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.monotonic()
+        self.commands = {}
+        self.errors = {}
+        self.timings = {}
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.gauges = {}
+
+    def observe_command(self, command, seconds, error=False):
+        with self.lock:
+            histogram = self.commands.get(command)
+            if histogram is None:
+                histogram = self.commands[command] = Histogram()
+                self.errors[command] = 0
+            histogram.observe(seconds)
+            if error:
+                self.errors[command] += 1
+
+    @contextmanager
+    def time_command(self, command):
+        """Time the ``with`` block as one run of ``command``; an exception counts as an error."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe_command(command, time.perf_counter() - started, error=True)
+            raise
+        self.observe_command(command, time.perf_counter() - started)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.timings.get(name)
+            if histogram is None:
+                histogram = self.timings[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count_bytes(self, received=0, sent=0):
+        with self.lock:
+            self.bytes_in += received
+            self.bytes_out += sent
+
+    def gauge(self, name, read):
+        """Register ``read()`` to be reported as the gauge ``name``."""
+        self.gauges[name] = read
+
+    def snapshot(self):
+        """Return every metric as a dict of plain values."""
+        with self.lock:
+            snapshot = {
+                "uptime": time.monotonic() - self.started_at,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "commands": {command: {**histogram.snapshot(), "errors": self.errors[command]}
+                             for command, histogram in self.commands.items()},
+                "timings": {name: histogram.snapshot() for name, histogram in self.timings.items()},
+            }
+        snapshot["gauges"] = {name: read() for name, read in list(self.gauges.items())}
+        return snapshot
+
+    def render_text(self, prefix="ycap"):
+        """Render the metrics in the Prometheus text exposition format."""
+        with self.lock:
+            lines = [
+                f"{prefix}_uptime_seconds {time.monotonic() - self.started_at:.3f}",
+                f"{prefix}_bytes_received_total {self.bytes_in}",
+                f"{prefix}_bytes_sent_total {self.bytes_out}",
+            ]
+            for command, histogram in sorted(self.commands.items()):
+                lines.append(f'{prefix}_command_errors_total{{command="{command}"}} {self.errors[command]}')
+                lines.extend(_histogram_lines(f"{prefix}_command_seconds", f'command="{command}"', histogram))
+            for name, histogram in sorted(self.timings.items()):
+                lines.extend(_histogram_lines(f"{prefix}_{name}_seconds", "", histogram))
+        for name, read in sorted(self.gauges.items()):
+            lines.append(f"{prefix}_{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+
+def _histogram_lines(metric, labels, histogram):
+    separator = "," if labels else ""
+    seen = 0
+    for bound, count in zip(histogram.bounds + ("+Inf",), histogram.buckets):
+        seen += count
+        yield f'{metric}_bucket{{{labels}{separator}le="{bound}"}} {seen}'
+    suffix = f"{{{labels}}}" if labels else ""
+    yield f"{metric}_sum{suffix} {histogram.total:.6f}"
+    yield f"{metric}_count{suffix} {histogram.count}"
+
+
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    """Serve ``metrics.render_text()`` over HTTP from a daemon thread.
+
+    Binds to loopback by default, so only local tools and scrapers can read it.
+
+    Returns:
+        http.server.ThreadingHTTPServer: The running server; call ``shutdown()`` to stop it
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.render_text().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True, name="ycap-metrics").start()
+    return server
@@ -0,0 +1,200 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+"""
+YCAP Password Hashing
+
+Passwords are stored as salted scrypt hashes (PBKDF2-SHA256 where the hashlib build has no
+scrypt). A KDF is slow on purpose, so PasswordHasher runs it in a small process pool and caps
+how many logins and signups may wait on it at once; handshakes and the event loop never run
+it themselves.
+
+Stored formats, one per ``users.password`` value:
+    scrypt$<n>$<r>$<p>$<salt>$<hash>        salt and hash base64, current default
+    pbkdf2_sha256$<iterations>$<salt>$<hash>
+    plain$<password>                        legacy row, upgraded at its next successful login
+"""
+
+SCRYPT_N = 2 ** 14
+SCRYPT_R = 8
+SCRYPT_P = 1
+PBKDF2_ITERATIONS = 600000
+SALT_BYTES = 16
+HASH_BYTES = 32
+# rows written before passwords were hashed carry this prefix (schema migration 6)
+LEGACY_PREFIX = "plain$"
+HAS_SCRYPT = hasattr(hashlib, "scrypt")
+
+
+def _b64(data):
+    return base64.b64encode(data).decode()
+
+
+def hash_password(password):
+    """Hash ``password`` with a fresh salt in the current default format.
+
+    Args:
+        password (str): Password in clear
+
+    Returns:
+        str: Value to store in ``users.password``
+    """
+    salt = os.urandom(SALT_BYTES)
+    if HAS_SCRYPT:
+        digest = hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=HASH_BYTES)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${_b64(salt)}${_b64(digest)}"
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), salt, PBKDF2_ITERATIONS, HASH_BYTES)
+    return f"pbkdf2_sha256${PBKDF2_ITERATIONS}${_b64(salt)}${_b64(digest)}"
+
+
+def needs_rehash(stored):
+    """True if ``stored`` is a legacy row or was hashed with other than the current parameters."""
+    if HAS_SCRYPT:
+        return not stored.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+    return not stored.startswith(f"pbkdf2_sha256${PBKDF2_ITERATIONS}$")
+
+
+def verify_password(password, stored):
+    """Check ``password`` against a stored value of any supported format.
+
+    Returns:
+        bool: True if the password matches; False for a wrong password or an unreadable value
+    """
+    if stored.startswith(LEGACY_PREFIX):
+        return hmac.compare_digest(password.encode(), stored[len(LEGACY_PREFIX):].encode())
+    fields = stored.split("$")
+    try:
+        if fields[0] == "scrypt" and len(fields) == 6:
+            n, r, p = int(fields[1]), int(fields[2]), int(fields[3])
+            expected = base64.b64decode(fields[5])
+            # the default maxmem of OpenSSL is too small for r=8 beyond n=2**14
+            digest = hashlib.scrypt(password.encode(), salt=base64.b64decode(fields[4]), n=n, r=r, p=p,
+                                    dklen=len(expected), maxmem=256 * n * r + 1024 * 1024)
+        elif fields[0] == "pbkdf2_sha256" and len(fields) == 4:
+            expected = base64.b64decode(fields[3])
+            digest = hashlib.pbkdf2_hmac("sha256", password.encode(), base64.b64decode(fields[2]), int(fields[1]),
+                                         len(expected))
+        else:
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, expected)
+
+
+def check_password(password, stored):
+    """Verify a password and hash it anew if its stored value is outdated, in one KDF worker call.
+
+    Returns:
+        tuple: (matches, new value to store or None)
+    """
+    if not verify_password(password, stored):
+        return False, None
+    return True, hash_password(password) if needs_rehash(stored) else None
+
+
+def _exit_with_parent(parent_pid):
+    """Pool worker initializer: exit once the server process is gone, even if it was killed."""
+    def watch():
+        while os.getppid() == parent_pid:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
+
+
+def _broke(future):
+    return not future.cancelled() and isinstance(future.exception(), BrokenProcessPool)
+
+
+class PasswordHasher:
+    """Runs password hashing and verification off the calling thread, in a bounded process pool.
+
+    At most ``max_pending`` KDF calls are queued or running at once; callers beyond that wait
+    for a slot, so a login storm queues up in front of the pool instead of piling work into it.
+    The pool is started on first use. ``workers=0`` runs the KDF in the calling thread instead,
+    for tools and tests that hash a handful of passwords.
+
+    Args:
+        workers (int): KDF worker processes
+        max_pending (int, optional): Cap on queued plus running KDF calls; defaults to twice ``workers``
+        metrics (ycap_metrics.Metrics, optional): Records each call as the ``password_kdf`` timing
+    """
+
+    def __init__(self, workers=2, max_pending=None, metrics=None):
+        self.workers = workers
+        self.max_pending = max_pending or max(1, workers * 2)
+        self.metrics = metrics
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.async_slots = None
+        self.pool = None
+        self.pool_lock = threading.Lock()
+
+    def _submit(self, func, *args):
+        with self.pool_lock:
+            if self.pool is None:
+                # spawn: forking a process full of server threads could copy a held lock
+                self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_exit_with_parent, initargs=(os.getpid(),))
+            pool = self.pool
+        try:
+            future = pool.submit(func, *args)
+        except BrokenProcessPool:
+            self._discard(pool)
+            raise
+        future.add_done_callback(lambda done: self._discard(pool) if _broke(done) else None)
+        return future
+
+    def _discard(self, pool):
+        # a worker died (killed, out of memory); the next call starts a fresh pool
+        with self.pool_lock:
+            if self.pool is pool:
+                self.pool = None
+        pool.shutdown(wait=False, cancel_futures=True)
+
+    def _timed(self, started):
+        if self.metrics is not None:
+            self.metrics.observe("password_kdf", time.perf_counter() - started)
+
+    def run(self, func, *args):
+        """Run ``func(*args)`` on the pool and wait for its result."""
+        with self.slots:
+            started = time.perf_counter()
+            try:
+                if not self.workers:
+                    return func(*args)
+                return self._submit(func, *args).result()
+            finally:
+                self._timed(started)
+
+    async def run_async(self, func, *args):
+        """Coroutine twin of run; waits for a slot and the result without blocking the event loop."""
+        if self.async_slots is None:
+            self.async_slots = asyncio.Semaphore(self.max_pending)
+        async with self.async_slots:
+            started = time.perf_counter()
+            try:
+                if not self.workers:
+                    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+                return await asyncio.wrap_future(self._submit(func, *args))
+            finally:
+                self._timed(started)
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def check(self, password, stored):
+        """See check_password."""
+        return self.run(check_password, password, stored)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,531 @@
+import asyncio
+import base64
+import functools
+import json
+import lzma
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+"""
+YCAP Wire Protocol Helpers
+
+This module holds the pieces of the YCAP wire format shared by the server and the client.
+Framed YCAP prefixes every packet with a 4 byte big-endian length header so packets can be
+pipelined on one socket without being truncated or glued together by the transport.
+"""
+
+FRAME_HEADER = struct.Struct(">I")
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+# frame limit before a session is verified; login packets are a few hundred bytes
+MAX_HANDSHAKE_FRAME_SIZE = 64 * 1024
+RECV_CHUNK_SIZE = 65536
+# body chunk size of streamed transfers (SGMA/SYAP); an empty frame ends the stream
+STREAM_CHUNK_SIZE = 256 * 1024
+# command of the packets the server pushes to subscribed sessions when mail arrives for them
+PUSH_COMMAND = "NEW_MAIL"
+# mail bodies shorter than this many bytes are never compressed
+COMPRESSION_THRESHOLD = 1024
+# a packed body may unpack to at most this many bytes, so a small upload cannot turn into a huge one
+MAX_UNPACKED_SIZE = MAX_FRAME_SIZE
+
+
+class ProtocolError(ConnectionError):
+    """Raised when a peer sends bytes that are not valid framed YCAP."""
+
+
+class CompressionError(ValueError):
+    """Raised for a packed body that is corrupt, truncated or unpacks to more than its limit."""
+
+
+@functools.lru_cache(maxsize=None)
+def load_ycap_key(key_file=None):
+    """Load the shared YCAP master key once per process.
+
+    Looks at ``key_file``, then the file named by ``YCAP_KEY_FILE``, then ``YCAP_KEY``.
+    The result is cached, so handshakes never re-read the environment or the disk.
+
+    Args:
+        key_file (str, optional): Path of a file holding the urlsafe base64 Fernet key
+
+    Returns:
+        bytes: The YCAP master key
+    """
+    key_file = key_file or os.environ.get("YCAP_KEY_FILE")
+    if key_file:
+        with open(key_file, "rb") as f:
+            key = f.read().strip()
+    else:
+        key = os.environ.get("YCAP_KEY", "").strip().encode()
+    if not key:
+        raise RuntimeError("YCAP key not found: set YCAP_KEY or YCAP_KEY_FILE")
+    return key
+
+
+def encode_frame(payload):
+    """Prefix a payload with its length header.
+
+    Args:
+        payload (bytes): Packet bytes to frame
+
+    Returns:
+        bytes: Length header followed by the payload
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"Frame of {len(payload)} bytes exceeds the {MAX_FRAME_SIZE} byte limit")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """Streaming decoder for length-prefixed frames.
+
+    Bytes are fed in exactly as they come off the socket. Partial frames stay buffered
+    until the rest arrives, and reads holding several frames yield them one by one.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Append received bytes to the decoder buffer."""
+        self._buffer += data
+
+    def next_frame(self):
+        """Pop the next complete frame.
+
+        Returns:
+            bytes: Payload of the next frame
+            None: If no complete frame is buffered yet
+        """
+        if len(self._buffer) < FRAME_HEADER.size:
+            return None
+        (length,) = FRAME_HEADER.unpack_from(self._buffer)
+        if length > self.max_frame_size:
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+        end = FRAME_HEADER.size + length
+        if len(self._buffer) < end:
+            return None
+        frame = bytes(self._buffer[FRAME_HEADER.size:end])
+        del self._buffer[:end]
+        return frame
+
+    def frames(self, data=b""):
+        """Feed bytes and return every frame that is now complete."""
+        if data:
+            self.feed(data)
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+
+class JsonCodec:
+    """Packets as UTF-8 JSON text, the original YCAP encoding."""
+
+    name = "json"
+
+    def encode(self, packet):
+        return json.dumps(packet).encode()
+
+    def decode(self, data):
+        return json.loads(data)
+
+
+class BinaryCodec:
+    """Compact tagged binary packet encoding.
+
+    Every value is a one byte type tag followed by its payload. Strings and byte strings
+    carry a 4 byte length and their raw bytes, so mail bodies travel without JSON escaping.
+    Integers are signed 64 bit and floats are IEEE doubles. Lists and dicts carry their item
+    count followed by the items (dicts alternate keys and values).
+    """
+
+    name = "binary"
+
+    NONE, FALSE, TRUE, INT, FLOAT, STR, BYTES, LIST, DICT = range(9)
+    LENGTH = struct.Struct(">BI")
+    INT64 = struct.Struct(">Bq")
+    DOUBLE = struct.Struct(">Bd")
+
+    def encode(self, packet):
+        parts = []
+        self._pack(packet, parts.append)
+        return b"".join(parts)
+
+    def _pack(self, value, out):
+        kind = type(value)
+        if kind is str:
+            raw = value.encode()
+            out(self.LENGTH.pack(self.STR, len(raw)))
+            out(raw)
+        elif kind is dict:
+            out(self.LENGTH.pack(self.DICT, len(value)))
+            for key, item in value.items():
+                self._pack(key, out)
+                self._pack(item, out)
+        elif kind is list or kind is tuple:
+            out(self.LENGTH.pack(self.LIST, len(value)))
+            for item in value:
+                self._pack(item, out)
+        elif kind is bytes or kind is bytearray or kind is memoryview:
+            out(self.LENGTH.pack(self.BYTES, len(value)))
+            out(bytes(value))
+        elif value is None:
+            out(bytes((self.NONE,)))
+        elif kind is bool:
+            out(bytes((self.TRUE if value else self.FALSE,)))
+        elif kind is int:
+            out(self.INT64.pack(self.INT, value))
+        elif kind is float:
+            out(self.DOUBLE.pack(self.FLOAT, value))
+        else:
+            raise TypeError(f"Cannot encode {kind.__name__} in a YCAP packet")
+
+    def decode(self, data):
+        value, end = self._unpack(data, 0)
+        if end != len(data):
+            raise ProtocolError("Trailing bytes after binary YCAP packet")
+        return value
+
+    def _unpack(self, data, pos):
+        tag = data[pos]
+        if tag == self.STR or tag == self.BYTES:
+            _, length = self.LENGTH.unpack_from(data, pos)
+            start = pos + self.LENGTH.size
+            end = start + length
+            if end > len(data):
+                raise ProtocolError("Truncated binary YCAP packet")
+            if tag == self.STR:
+                return str(data[start:end], "utf-8"), end
+            return bytes(data[start:end]), end
+        if tag == self.DICT:
+            _, count = self.LENGTH.unpack_from(data, pos)
+            pos += self.LENGTH.size
+            value = {}
+            for _ in range(count):
+                key, pos = self._unpack(data, pos)
+                value[key], pos = self._unpack(data, pos)
+            return value, pos
+        if tag == self.LIST:
+            _, count = self.LENGTH.unpack_from(data, pos)
+            pos += self.LENGTH.size
+            value = []
+            for _ in range(count):
+                item, pos = self._unpack(data, pos)
+                value.append(item)
+            return value, pos
+        if tag == self.NONE:
+            return None, pos + 1
+        if tag == self.FALSE:
+            return False, pos + 1
+        if tag == self.TRUE:
+            return True, pos + 1
+        if tag == self.INT:
+            return self.INT64.unpack_from(data, pos)[1], pos + self.INT64.size
+        if tag == self.FLOAT:
+            return self.DOUBLE.unpack_from(data, pos)[1], pos + self.DOUBLE.size
+        raise ProtocolError(f"Unknown binary YCAP type tag {tag}")
+
+
+JSON_CODEC = JsonCodec()
+BINARY_CODEC = BinaryCodec()
+CODECS = {codec.name: codec for codec in (BINARY_CODEC, JSON_CODEC)}
+
+
+def choose_codec(offered):
+    """Pick the first codec in the client's preference list that this side supports.
+
+    Args:
+        offered (list): Codec names offered in the handshake, most preferred first
+
+    Returns:
+        JsonCodec | BinaryCodec: The agreed codec; JSON when nothing offered is known
+    """
+    for name in offered or ():
+        if name in CODECS:
+            return CODECS[name]
+    return JSON_CODEC
+
+
+class BodyCompression:
+    """One mail body compression scheme (a ``zlib`` or ``lzma`` style module)."""
+
+    def __init__(self, name, module):
+        self.name = name
+        self.module = module
+
+    def compress(self, data):
+        return self.module.compress(data)
+
+    def decompress(self, data, limit=MAX_UNPACKED_SIZE):
+        """Unpack a whole body, refusing corrupt or truncated data and output beyond ``limit`` bytes."""
+        decompressor = self.decompressor()
+        try:
+            # one byte more than allowed tells an oversized body from one of exactly ``limit`` bytes
+            body = decompressor.decompress(data, limit + 1)
+        except (zlib.error, lzma.LZMAError) as e:
+            raise CompressionError(f"Corrupt {self.name} body: {e}") from None
+        if len(body) > limit:
+            raise CompressionError(f"{self.name} body unpacks to more than {limit} bytes")
+        if not decompressor.eof:
+            raise CompressionError(f"Truncated {self.name} body")
+        return body
+
+    def decompressor(self):
+        """Incremental decompressor for bodies that arrive in chunks."""
+        if self.module is zlib:
+            return zlib.decompressobj()
+        return lzma.LZMADecompressor()
+
+
+COMPRESSIONS = {scheme.name: scheme for scheme in (BodyCompression("zlib", zlib), BodyCompression("lzma", lzma))}
+
+
+def choose_compression(offered):
+    """Pick the first compression in the client's preference list that this side supports.
+
+    Args:
+        offered (list): Compression names offered in the handshake, most preferred first
+
+    Returns:
+        str: Name of the agreed compression
+        None: If nothing offered is known, so bodies travel uncompressed
+    """
+    for name in offered or ():
+        if name in COMPRESSIONS:
+            return name
+    return None
+
+
+def compress_body(body, name):
+    """Compress a mail body when it is big enough and compression actually pays off.
+
+    Args:
+        body (str | bytes): Mail body
+        name (str): Compression name, or None to leave the body alone
+
+    Returns:
+        tuple: (stored body, compression name); ``(body, None)`` when left uncompressed
+    """
+    if name is None or not isinstance(body, (str, bytes)):
+        return body, None
+    raw = body.encode() if isinstance(body, str) else body
+    if len(raw) < COMPRESSION_THRESHOLD:
+        return body, None
+    packed = COMPRESSIONS[name].compress(raw)
+    if len(packed) >= len(raw):
+        return body, None
+    return packed, name
+
+
+def decompress_body(body, name):
+    """Undo compress_body and return the body as text.
+
+    Args:
+        body (str | bytes): Stored or received mail body
+        name (str): Compression the body is packed with, or None
+
+    Returns:
+        str: Mail body text
+
+    Raises:
+        CompressionError: If the body is corrupt or unpacks to more than MAX_UNPACKED_SIZE bytes
+    """
+    if name is not None:
+        body = COMPRESSIONS[name].decompress(body)
+    if isinstance(body, bytes):
+        return body.decode("utf-8", "replace")
+    return body
+
+
+def body_to_wire(body, codec):
+    """Put compressed body bytes into a packet; JSON cannot carry bytes, so it gets base64."""
+    if codec.name == "json":
+        return base64.b64encode(body).decode("ascii")
+    return body
+
+
+def body_from_wire(value):
+    """Inverse of body_to_wire."""
+    if isinstance(value, str):
+        return base64.b64decode(value)
+    return value
+
+
+def _limit_to_deadline(sock, deadline):
+    """Give the next socket call only the time left until ``deadline`` (a time.monotonic() value)."""
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise socket.timeout("Deadline passed")
+    sock.settimeout(remaining)
+
+
+class FramedChannel:
+    """Socket wrapper that sends and receives whole framed YCAP packets.
+
+    Writers that may race (a response and a server push) hold ``send_lock`` around every
+    run of frames that must stay together, such as a streamed body. Setting ``metrics`` to a
+    ycap_metrics.Metrics counts the bytes the channel moves. Setting ``deadline`` to a
+    time.monotonic() value makes every socket call time out once it has passed, so a peer
+    that drips bytes cannot stretch an exchange beyond it. ``max_frame_size`` caps the
+    frames the peer may send and can be raised once the peer is trusted.
+    """
+
+    framed = True
+    metrics = None
+    deadline = None
+
+    def __init__(self, sock, max_frame_size=MAX_FRAME_SIZE):
+        self.sock = sock
+        self.decoder = FrameDecoder(max_frame_size)
+        self.send_lock = threading.RLock()
+
+    @property
+    def max_frame_size(self):
+        return self.decoder.max_frame_size
+
+    @max_frame_size.setter
+    def max_frame_size(self, size):
+        self.decoder.max_frame_size = size
+
+    def send(self, payload):
+        frame = encode_frame(payload)
+        if self.deadline is not None:
+            _limit_to_deadline(self.sock, self.deadline)
+        self.sock.sendall(frame)
+        if self.metrics is not None:
+            self.metrics.count_bytes(sent=len(frame))
+
+    def recv(self):
+        """Block until one whole packet has arrived.
+
+        Returns:
+            bytes: Packet payload
+            None: If the peer closed the connection
+        """
+        frame = self.decoder.next_frame()
+        while frame is None:
+            if self.deadline is not None:
+                _limit_to_deadline(self.sock, self.deadline)
+            data = self.sock.recv(RECV_CHUNK_SIZE)
+            if not data:
+                return None
+            if self.metrics is not None:
+                self.metrics.count_bytes(received=len(data))
+            self.decoder.feed(data)
+            frame = self.decoder.next_frame()
+        return frame
+
+    def close(self):
+        try:
+            # unblocks a recv() waiting on this socket in another thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class RawChannel:
+    """Legacy unframed YCAP: one ``recv`` is assumed to be one packet."""
+
+    framed = False
+    metrics = None
+    deadline = None
+
+    def __init__(self, sock, bufsize=10500000):
+        self.sock = sock
+        self.bufsize = bufsize
+        self.send_lock = threading.RLock()
+
+    def send(self, payload):
+        if self.deadline is not None:
+            _limit_to_deadline(self.sock, self.deadline)
+        sent = self.sock.send(payload)
+        if self.metrics is not None:
+            self.metrics.count_bytes(sent=sent)
+
+    def recv(self):
+        if self.deadline is not None:
+            _limit_to_deadline(self.sock, self.deadline)
+        data = self.sock.recv(self.bufsize)
+        if not data:
+            return None
+        if self.metrics is not None:
+            self.metrics.count_bytes(received=len(data))
+        return data
+
+    def close(self):
+        try:
+            # unblocks a recv() waiting on this socket in another thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+def accept_channel(sock, max_frame_size=MAX_FRAME_SIZE):
+    """Pick the channel type for a freshly accepted socket.
+
+    Framed clients open with the length header of their email packet, whose first byte is
+    always zero, while legacy clients open with the email text itself.
+
+    Args:
+        sock (socket.socket): Accepted client socket
+        max_frame_size (int): Frame limit of a framed channel
+
+    Returns:
+        FramedChannel | RawChannel: Channel matching the client's wire mode
+    """
+    first = sock.recv(1, socket.MSG_PEEK)
+    if first == b"\x00":
+        return FramedChannel(sock, max_frame_size)
+    return RawChannel(sock)
+
+
+class AsyncFramedChannel:
+    """asyncio stream twin of FramedChannel; ``send_lock`` is an asyncio.Lock here."""
+
+    framed = True
+    metrics = None
+
+    def __init__(self, reader, writer, max_frame_size=MAX_FRAME_SIZE):
+        self.reader = reader
+        self.writer = writer
+        self.max_frame_size = max_frame_size
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, payload):
+        frame = encode_frame(payload)
+        self.writer.write(frame)
+        if self.metrics is not None:
+            self.metrics.count_bytes(sent=len(frame))
+        await self.writer.drain()
+
+    async def recv(self):
+        """Wait for one whole packet.
+
+        Returns:
+            bytes: Packet payload
+            None: If the peer closed the connection
+        """
+        try:
+            header = await self.reader.readexactly(FRAME_HEADER.size)
+        except asyncio.IncompleteReadError:
+            return None
+        (length,) = FRAME_HEADER.unpack(header)
+        if length > self.max_frame_size:
+            # legacy clients open with plain text, which decodes as an absurd length
+            raise ProtocolError(f"Frame of {length} bytes exceeds the {self.max_frame_size} byte limit")
+        payload = await self.reader.readexactly(length)
+        if self.metrics is not None:
+            self.metrics.count_bytes(received=FRAME_HEADER.size + length)
+        return payload
+
+    def close(self):
+        self.writer.close()